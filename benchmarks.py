@@ -0,0 +1,135 @@
+"""Benchmark functions.
+
+Run this file to print the results of the benchmarks that don't need API keys, or call the functions one by one.
+"""
+
+import copy
+import json
+import logging
+import re
+import timeit
+from pathlib import Path
+from typing import Any
+
+from langchain.text_splitter import TextSplitter
+
+from knowledge_net.chat.chat_event import MessageEvent, Role, CallEvent, ChatEvent
+from knowledge_net.chat.chat_history import ChatHistory
+from knowledge_net.experimental.database.sentence_splitter import SentenceTextSplitter
+
+
+def make_chat_history(n_events: int) -> ChatHistory:
+    """Makes a chat history alternating user questions and assistant answers."""
+    roles = [Role.user, Role.assistant]
+    return ChatHistory([MessageEvent(role=roles[i % 2], originator="user" if i % 2 == 0 else "kb",
+                                     message_text=f"Message number {i}. " * 20)
+                        for i in range(n_events)])
+
+
+def route(chat_history: ChatHistory, depth: int, copy_function) -> ChatHistory:
+    """Imitates a chain of local knowledge bases, each copying the history and adding a call event."""
+    for level in range(depth):
+        chat_history = copy_function(chat_history)
+        chat_history.append(CallEvent(caller=f"kb{level}", called=f"kb{level + 1}"))
+    return chat_history
+
+
+def deep_copy(chat_history: ChatHistory) -> ChatHistory:
+    """Copies the history the way it was done before events were shared, for comparison."""
+    return ChatHistory(copy.deepcopy(list(chat_history.events())))
+
+
+def benchmark_chat_history_copy(lengths: tuple[int, ...] = (10, 100, 1000), depths: tuple[int, ...] = (1, 4, 16),
+                                repeat: int = 20):
+    """Compares structurally shared copies with deep copies as history length and routing depth grow."""
+    print(f"{'events':>8} {'depth':>6} {'shared (ms)':>12} {'deepcopy (ms)':>14}")
+    for n in lengths:
+        chat_history = make_chat_history(n)
+        for depth in depths:
+            shared = timeit.timeit(lambda: route(chat_history, depth, ChatHistory.copy), number=repeat) / repeat
+            deep = timeit.timeit(lambda: route(chat_history, depth, deep_copy), number=repeat) / repeat
+            print(f"{n:>8} {depth:>6} {shared * 1000:>12.3f} {deep * 1000:>14.3f}")
+
+
+def benchmark_chat_history_codec(n_events: int = 1000, repeat: int = 20):
+    """Compares encoding and decoding through the codec with pydantic dumping and validation of every event."""
+    chat_history = make_chat_history(n_events)
+    encoded = chat_history.as_json_bytes()
+
+    def pydantic_encode():
+        return json.dumps([e.to_dict() for e in chat_history.events()])
+
+    def pydantic_decode():
+        return ChatHistory([ChatEvent.from_dict(d) for d in json.loads(encoded)])
+
+    timings = {
+        'encode, pydantic': timeit.timeit(pydantic_encode, number=repeat),
+        'encode, codec': timeit.timeit(chat_history.as_json_bytes, number=repeat),
+        'decode, pydantic': timeit.timeit(pydantic_decode, number=repeat),
+        'decode, codec': timeit.timeit(lambda: ChatHistory.from_json(encoded), number=repeat)
+    }
+    print(f"{n_events}-event history, {len(encoded)} bytes")
+    for name, seconds in timings.items():
+        print(f"{name:>18}: {n_events * repeat / seconds:>12,.0f} events/s")
+
+
+class ReferenceSentenceTextSplitter(TextSplitter):
+    """The sentence splitter as it was before it worked on offsets, for comparison."""
+
+    SPLIT_PATTERN = "[.?!]|\n\n"
+
+    def __init__(self, chunk_size: int = 1200, chunk_overlap: int = 400, add_start_index: bool = True,
+                 **kwargs: Any):
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=add_start_index,
+                         keep_separator=True, **kwargs)
+
+    def split_text(self, text: str) -> list[str]:
+        first_splits = self.split_on_pattern(text)
+        sentences = self.append_separators(first_splits)
+        return self._merge_splits(sentences, separator="")
+
+    def split_on_pattern(self, text: str) -> list[str]:
+        return [s for s in re.split(f"({self.SPLIT_PATTERN})", text) if s]
+
+    def append_separators(self, splits: list[str]) -> list[str]:
+        concatenated = []
+        for s in splits:
+            if concatenated and re.fullmatch(self.SPLIT_PATTERN, s):
+                concatenated[-1] += s
+            else:
+                concatenated.append(s)
+        return concatenated
+
+
+def benchmark_sentence_splitter(folders: tuple[str, ...] = ("examples/documents/darwin", "examples/documents/galton"),
+                                repeat: int = 3):
+    """Compares the sentence splitter with the reference implementation on the bundled corpus.
+
+    Checks that both produce the same chunks with the same start indexes.
+    """
+    texts = [f.read_text() for folder in folders for f in sorted(Path(folder).glob("*.txt"))]
+    n_chars = sum(len(t) for t in texts)
+    splitter, reference = SentenceTextSplitter(), ReferenceSentenceTextSplitter()
+
+    # Both splitters warn about sentences longer than a chunk
+    logging.disable(logging.WARNING)
+    try:
+        documents = splitter.create_documents(texts)
+        expected = reference.create_documents(texts)
+        same = [(d.page_content, d.metadata) for d in documents] == [(d.page_content, d.metadata) for d in expected]
+        timings = {
+            'reference': timeit.timeit(lambda: reference.create_documents(texts), number=repeat) / repeat,
+            'offsets': timeit.timeit(lambda: splitter.create_documents(texts), number=repeat) / repeat
+        }
+    finally:
+        logging.disable(logging.NOTSET)
+    print(f"{len(texts)} texts, {n_chars / 1e6:.1f}M characters, {len(documents)} chunks, "
+          f"{'identical' if same else 'DIFFERENT'} chunks and start indexes")
+    for name, seconds in timings.items():
+        print(f"{name:>10}: {seconds * 1000:>8.0f} ms, {n_chars / seconds / 1e6:>6.1f}M characters/s")
+
+
+if __name__ == "__main__":
+    benchmark_chat_history_copy()
+    benchmark_chat_history_codec()
+    benchmark_sentence_splitter()
@@ -1,3 +1,4 @@
+import json
 import sys
 from pathlib import Path
 
@@ -5,12 +6,29 @@ from knowledge_net.experimental.database.database import Database
 from knowledge_net.experimental.database.document_processor import TextDocumentProcessor
 from credentials import openai_api_key
 
-if len(sys.argv) != 3:
-    print("Usage: python build_database.py <document directory> <db directory>")
+incremental = "--incremental" in sys.argv
+embeddings = None
+args = []
+for a in sys.argv[1:]:
+    if a == "--incremental":
+        continue
+    if a.startswith("--embeddings="):
+        value = a[len("--embeddings="):]
+        embeddings = json.loads(value) if value.startswith("{") else {"provider": value}
+        continue
+    args.append(a)
+
+if len(args) != 2:
+    print("Usage: python build_database.py [--incremental] [--embeddings=<provider or json configuration>] "
+          "<document directory> <db directory>")
     sys.exit()
 
-document_path = Path(sys.argv[1])
-database_path = Path(sys.argv[2])
+document_path = Path(args[0])
+database_path = Path(args[1])
 
 processor = TextDocumentProcessor()
-Database(database_path, openai_api_key=openai_api_key).build_from_folder(document_path, processor)
+database = Database(database_path, openai_api_key=openai_api_key, embeddings=embeddings)
+if incremental:
+    database.build_incrementally_from_folder(document_path, processor)
+else:
+    database.build_from_folder(document_path, processor)
@@ -0,0 +1,81 @@
+import json
+from enum import Enum
+from typing import Any, Union
+
+from pydantic import BaseModel
+
+from knowledge_net.chat.chat_event import ChatEvent, event_classes
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ChatCodec:
+    """
+    All-static class converting chat events to and from their wire format.
+
+    The wire format is the JSON representation of the events' fields, the same as produced by pydantic. To keep
+    chat histories cheap to pass between knowledge bases, events are written without pydantic's serialization
+    machinery, taking the field values directly from the model. With pydantic 2, events are read with
+    :code:`model_validate`, whose compiled validator is the fastest way to build them. With pydantic 1, whose
+    validation is slow, events are constructed from the decoded values after converting enum fields. Events missing
+    a required field are validated the normal way, which raises a validation error.
+
+    JSON is encoded and decoded with orjson if it is installed, and with the standard library otherwise.
+    """
+
+    # Work with both Pydantic version 1 and 2 since ChromaDb requires v1
+    PYDANTIC_V2 = hasattr(BaseModel, "model_dump")
+
+    _field_specs: dict[type, tuple[frozenset[str], dict[str, type], frozenset[str]]] = {}
+
+    @staticmethod
+    def dumps(data: Any) -> bytes:
+        """Encodes the data as JSON."""
+        if orjson is not None:
+            return orjson.dumps(data)
+        return json.dumps(data).encode('utf-8')
+
+    @staticmethod
+    def loads(data: Union[str, bytes]) -> Any:
+        """Decodes JSON data."""
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+    @staticmethod
+    def event_to_dict(event: ChatEvent) -> dict[str, Any]:
+        """Returns the fields of the event as a dictionary."""
+        return dict(event.__dict__)
+
+    @staticmethod
+    def event_from_dict(d: dict[str, Any]) -> ChatEvent:
+        """Creates an event from a dictionary of its fields."""
+        assert 'event_type' in d, "Event type ('event_type') required"
+        event_class = event_classes[d['event_type']]
+        if ChatCodec.PYDANTIC_V2:
+            return event_class.model_validate(d)
+        field_names, enum_fields, required_fields = ChatCodec._specs(event_class)
+        if not required_fields.issubset(d):
+            return event_class.parse_obj(d)
+        values = {k: v for k, v in d.items() if k in field_names}
+        for name, enum_class in enum_fields.items():
+            if name in values:
+                values[name] = enum_class(values[name])
+        return event_class.construct(**values)
+
+    @staticmethod
+    def _specs(event_class: type) -> tuple[frozenset[str], dict[str, type], frozenset[str]]:
+        """Returns the field names, enum fields and required fields of a pydantic 1 event class.
+
+        The class is inspected on first use.
+        """
+        specs = ChatCodec._field_specs.get(event_class)
+        if specs is None:
+            fields = {name: (f.outer_type_, f.required) for name, f in event_class.__fields__.items()}
+            enum_fields = {name: t for name, (t, _) in fields.items() if isinstance(t, type) and issubclass(t, Enum)}
+            required_fields = frozenset(name for name, (_, required) in fields.items() if required)
+            specs = ChatCodec._field_specs[event_class] = (frozenset(fields), enum_fields, required_fields)
+        return specs
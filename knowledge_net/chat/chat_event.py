@@ -31,7 +31,17 @@ class SummaryType(str, Enum):
 
 
 class ChatEvent(BaseModel):
-    """Base class of chat history events."""
+    """Base class of chat history events.
+
+    Events are immutable, which lets chat histories share them instead of copying.
+    """
+
+    # Work with both Pydantic version 1 and 2 since ChromaDb requires v1
+    if hasattr(BaseModel, "model_dump"):
+        model_config = {'frozen': True}
+    else:
+        class Config:
+            frozen = True
 
     event_type: EventType = EventType.message
 
@@ -80,7 +90,7 @@ class CallEvent(ChatEvent):
     caller: str = "user"
     called: str
     time_stamp: str = datetime.now(tz=pytz.timezone(DEFAULT_TIME_ZONE)).isoformat()
-    time_out_seconds: int = 0
+    time_out_seconds: float = 0
 
 
 class ReturnEvent(ChatEvent):
@@ -1,10 +1,56 @@
-import copy
-import json
-from datetime import datetime, timedelta
-from typing import Optional, Any, Tuple
+import threading
+import uuid
+from bisect import bisect_left
+from datetime import datetime
+from itertools import islice
+from typing import Optional, Any, Tuple, Iterator, Union
 import pytz
+from knowledge_net.chat.chat_codec import ChatCodec
 from knowledge_net.chat.chat_event import ChatEvent, EventType, CallEvent, ReturnEvent, DEFAULT_TIME_ZONE, SummaryType, \
-    MessageEvent
+    MessageEvent, SummaryEvent
+
+
+class _EventLog:
+    """Append-only list of events shared between a chat history and its copies.
+
+    The log keeps the positions of messages and summaries, in increasing order, so that the common queries don't
+    scan the events. A view of the first n events finds its part of an index with a binary search.
+    """
+
+    def __init__(self, events: list[ChatEvent]):
+        self.events: list[ChatEvent] = []
+        self.message_positions: list[int] = []
+        self.visible_message_positions: list[int] = []
+        self.summary_positions: dict[str, list[int]] = {}
+        self.lock = threading.Lock()
+        self.add(events)
+
+    def add(self, events: list[ChatEvent]):
+        """Appends events and updates the indexes."""
+        for event in events:
+            position = len(self.events)
+            self.events.append(event)
+            if event.event_type == EventType.message:
+                self.message_positions.append(position)
+                if not event.hidden:
+                    self.visible_message_positions.append(position)
+            elif event.event_type == EventType.summary:
+                self.summary_positions.setdefault(event.summary_type, []).append(position)
+
+    def prefix(self, length: int) -> "_EventLog":
+        """Returns a new log with the first length events."""
+        log = _EventLog([])
+        log.events = self.events[:length]
+        log.message_positions = self.message_positions[:_EventLog.count_before(self.message_positions, length)]
+        log.visible_message_positions = \
+            self.visible_message_positions[:_EventLog.count_before(self.visible_message_positions, length)]
+        log.summary_positions = {t: p[:_EventLog.count_before(p, length)] for t, p in self.summary_positions.items()}
+        return log
+
+    @staticmethod
+    def count_before(positions: list[int], length: int) -> int:
+        """Returns the number of positions smaller than length."""
+        return len(positions) if not positions or positions[-1] < length else bisect_left(positions, length)
 
 
 class ChatHistory:
@@ -19,62 +65,138 @@ class ChatHistory:
     - Timestamped events for calling and returning from knowledge bases
 
     Currently, messages are text only. Support for attachments of different types is planned.
+
+    Copies share their events. A chat history is a view of the first :code:`_length` events of an append-only
+    event log. Appending to the history that owns the end of the log appends in place; appending to any other view
+    first gives it a log of its own. Copying is therefore O(1), and appends never show up in other copies.
     """
 
-    def __init__(self, events: Optional[list[ChatEvent]] = None):
-        self._history: list[ChatEvent] = events or []
+    def __init__(self, events: Optional[list[ChatEvent]] = None, session_id: Optional[str] = None):
+        self._log = _EventLog(events or [])
+        self._length = len(self._log.events)
+        self._session_id = session_id
 
     def copy(self) -> "ChatHistory":
         """Makes a copy for passing between knowledge bases."""
-        return copy.deepcopy(self)
+        c = ChatHistory.__new__(ChatHistory)
+        c._log = self._log
+        c._length = self._length
+        c._session_id = self._session_id
+        return c
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getstate__(self) -> dict[str, Any]:
+        return {'events': list(self.events()), 'session_id': self._session_id}
+
+    def __setstate__(self, state: dict[str, Any]):
+        self.__init__(state['events'], state.get('session_id'))
+
+    def get_session_id(self) -> str:
+        """Returns the identifier of the conversation, shared by copies, creating it on first use.
+
+        Remote knowledge bases use it to recognize chat histories they have seen before.
+        """
+        if self._session_id is None:
+            self._session_id = uuid.uuid4().hex
+        return self._session_id
+
+    def set_session_id(self, session_id: Optional[str]):
+        self._session_id = session_id
+
+    def events(self, start: int = 0) -> Iterator[ChatEvent]:
+        """Iterates over the events, optionally skipping the first :code:`start` events."""
+        return islice(self._log.events, start, self._length)
+
+    def event_at(self, position: int) -> Optional[ChatEvent]:
+        """Returns the event at the position, or None if the position is outside the history."""
+        return self._log.events[position] if 0 <= position < self._length else None
 
     def is_empty(self) -> bool:
-        return not self._history
+        return self._length == 0
 
     def has_messages(self) -> bool:
-        return len(self.get_messages()) > 0
+        positions = self._log.visible_message_positions
+        return bool(positions) and positions[0] < self._length
 
-    def has_summary(self, summary_type=SummaryType.standalone_question):
-        last_event = self.get_last_event()
-        return last_event and last_event.event_type == EventType.summary and last_event.summary_type == summary_type
+    def has_summary(self, summary_type=SummaryType.standalone_question) -> bool:
+        """Returns true if the chat history ends with a summary of the type."""
+        position = self._last_summary_position(summary_type)
+        return position is not None and position == self._length - 1
 
     def get_last_event(self) -> ChatEvent:
-        return self._history[-1] if not self.is_empty() else None
+        return self._log.events[self._length - 1] if not self.is_empty() else None
 
     def get_messages(self, include_hidden: bool = False) -> list[ChatEvent]:
         """Returns the message events."""
-        return [e for e in self._history if e.event_type == EventType.message and (include_hidden or not e.hidden)]
+        positions = self._log.message_positions if include_hidden else self._log.visible_message_positions
+        events = self._log.events
+        return [events[i] for i in positions[:_EventLog.count_before(positions, self._length)]]
+
+    def get_last_message(self) -> Optional[MessageEvent]:
+        """Returns the last message that isn't hidden."""
+        positions = self._log.visible_message_positions
+        n = _EventLog.count_before(positions, self._length)
+        return self._log.events[positions[n - 1]] if n else None
 
     def get_last_message_text(self) -> Optional[str]:
-        messages = self.get_messages()
-        return messages[-1].message_text if messages else None
+        message = self.get_last_message()
+        return message.message_text if message else None
+
+    def get_last_summary(self, summary_type=SummaryType.standalone_question) -> Optional[SummaryEvent]:
+        """Returns the last summary of the type, wherever it is in the history."""
+        position = self._last_summary_position(summary_type)
+        return self._log.events[position] if position is not None else None
 
     def get_last_question(self) -> Optional[str]:
+        """Returns the standalone question ending the chat history, or else the text of the last message."""
         if self.has_summary(SummaryType.standalone_question):
-            return self.get_last_event().summary_text
+            return self.get_last_summary(SummaryType.standalone_question).summary_text
         else:
             return self.get_last_message_text()
 
+    def _last_summary_position(self, summary_type: SummaryType) -> Optional[int]:
+        positions = self._log.summary_positions.get(summary_type, [])
+        n = _EventLog.count_before(positions, self._length)
+        return positions[n - 1] if n else None
+
     def append(self, event: ChatEvent):
         """Appends an event to the end of the chat history."""
-        self._history.append(event)
+        self._append_events([event])
 
     def extend(self, other: "ChatHistory"):
         """Appends another chat history to self."""
-        self._history.extend(other._history)
-
-    def with_call_event(self, caller: str = "user", called: str = "", time_out_limit: timedelta = 0) -> "ChatHistory":
+        self._append_events(list(other.events()))
+
+    def _append_events(self, events: list[ChatEvent]):
+        """Appends in place if this history ends where the log ends, otherwise moves to a log of its own."""
+        with self._log.lock:
+            if self._length == len(self._log.events):
+                self._log.add(events)
+                self._length += len(events)
+                return
+        self._log = self._log.prefix(self._length)
+        self._log.add(events)
+        self._length += len(events)
+
+    def with_call_event(self, caller: str = "user", called: str = "", time_out_seconds: float = 0) -> "ChatHistory":
         """Adds a call event and returns self.
 
         Should be called right before calling another knowledge base. This is done automatically in the method
-        :code:`Knowledgebase.reply`.
+        :code:`Knowledgebase.reply`. A time out of 0 means that the caller waits indefinitely.
         """
         self.append(CallEvent(caller=caller,
                               called=called,
-                              timestamp=datetime.now(tz=pytz.timezone(DEFAULT_TIME_ZONE)),
-                              time_out_limit=time_out_limit))
+                              time_stamp=datetime.now(tz=pytz.timezone(DEFAULT_TIME_ZONE)).isoformat(),
+                              time_out_seconds=time_out_seconds))
         return self
 
+    def get_call_time_out(self) -> float:
+        """Returns the time out of the call event ending the chat history, 0 if there is none."""
+        last_event = self.get_last_event()
+        return last_event.time_out_seconds if last_event and last_event.event_type == EventType.call else 0
+
     def with_return_event(self, input_chat_history: "ChatHistory", error: Optional[str] = "") -> "ChatHistory":
         """Adds a return event and returns self.
 
@@ -87,8 +209,8 @@ class ChatHistory:
     @staticmethod
     def return_event_from_chat_history(input_chat_history: "ChatHistory", error: Optional[str] = "") -> ReturnEvent:
         """Creates a return event matching the call event at the end of the input chat history."""
-        last_event = input_chat_history._history[-1]
-        if last_event.event_type != EventType.call:
+        last_event = input_chat_history.get_last_event()
+        if last_event is None or last_event.event_type != EventType.call:
             raise ValueError("The input chat history should end with a call event")
 
         return ReturnEvent(caller=last_event.caller, called=last_event.called, error=error)
@@ -100,25 +222,27 @@ class ChatHistory:
 
     def returned_error(self):
         """Returns true if the last event is a return event with an error."""
-        return self._history and self._history[-1].event_type == EventType.ret and self._history[-1].error
+        last_event = self.get_last_event()
+        return last_event and last_event.event_type == EventType.ret and last_event.error
 
     def get_error(self) -> Tuple[str, str]:
         """Reports the called knowledge base name and the error if an error was returned.
 
         Check :code:`returned_error` before calling this.
         """
-        assert self._history and self._history[-1].event_type == EventType.ret
-        return self._history[-1].called, self._history[-1].error
+        last_event = self.get_last_event()
+        assert last_event and last_event.event_type == EventType.ret
+        return last_event.called, last_event.error
 
     @staticmethod
     def from_dict_list(dict_list: list[dict[str, Any]]) -> "ChatHistory":
         """Creates an instance from a list of dictionaries representing events."""
-        return ChatHistory([ChatEvent.from_dict(e) for e in dict_list])
+        return ChatHistory([ChatCodec.event_from_dict(e) for e in dict_list])
 
     @staticmethod
-    def from_json(json_data: str) -> "ChatHistory":
-        """Creates an instance from a json string."""
-        return ChatHistory.from_dict_list(json.loads(json_data))
+    def from_json(json_data: Union[str, bytes]) -> "ChatHistory":
+        """Creates an instance from a json string or UTF-8 encoded bytes."""
+        return ChatHistory.from_dict_list(ChatCodec.loads(json_data))
 
     @staticmethod
     def from_str(message: str) -> "ChatHistory":
@@ -127,11 +251,15 @@ class ChatHistory:
 
     def as_json(self) -> str:
         """Returns this instance as a json string."""
-        return json.dumps(self.to_dict_list())
+        return self.as_json_bytes().decode('utf-8')
+
+    def as_json_bytes(self) -> bytes:
+        """Returns this instance as UTF-8 encoded json."""
+        return ChatCodec.dumps(self.to_dict_list())
 
-    def to_dict_list(self) -> list[dict[str, Any]]:
-        """Returns a list of dictionaries representing this instance."""
-        return [e.to_dict() for e in self._history]
+    def to_dict_list(self, start: int = 0) -> list[dict[str, Any]]:
+        """Returns a list of dictionaries representing this instance, optionally from position :code:`start`."""
+        return [ChatCodec.event_to_dict(e) for e in self.events(start)]
 
     def __str__(self):
         """Returns a user-friendly string representation."""
@@ -1,3 +1,4 @@
+import asyncio
 from abc import ABC, abstractmethod
 
 from knowledge_net.chat.chat_history import ChatHistory
@@ -10,3 +11,14 @@ class ChatModel(ABC):
     def __call__(self, chat_history: ChatHistory, originator: str) -> ChatHistory:
         """Calls the model and returns the chat continuation."""
         pass
+
+    async def acall(self, chat_history: ChatHistory, originator: str) -> ChatHistory:
+        """Asynchronous version of :code:`__call__`. By default, runs :code:`__call__` in a worker thread."""
+        return await asyncio.to_thread(self, chat_history, originator)
+
+    def batch(self, chat_histories: list[ChatHistory], originator: str) -> list[ChatHistory]:
+        """Calls the model for many chat histories and returns the continuations in order.
+
+        By default, calls the model for each chat history.
+        """
+        return [self(chat_history, originator) for chat_history in chat_histories]
@@ -0,0 +1,43 @@
+from typing import Generator, Iterator, Optional
+
+from knowledge_net.chat.chat_event import MessageEvent, Role
+from knowledge_net.chat.chat_history import ChatHistory
+
+
+class ReplyStream:
+    """
+    A reply from a knowledge base delivered piece by piece.
+
+    Iterating over the stream yields message events holding successive pieces (deltas) of the reply text, as they
+    are produced. When the iteration is over, :code:`continuation` holds the complete continuation of the chat
+    history, the same as would have been returned by :code:`Knowledgebase.reply`. Deltas are not part of the
+    chat history.
+    """
+
+    def __init__(self, deltas: Generator[MessageEvent, None, ChatHistory]):
+        """Wraps a generator yielding the deltas and returning the continuation."""
+        self._deltas = deltas
+        self.continuation: Optional[ChatHistory] = None
+
+    def __iter__(self) -> Iterator[MessageEvent]:
+        self.continuation = yield from self._deltas
+
+    def text(self) -> Iterator[str]:
+        """Iterates over the text of the deltas."""
+        return (delta.message_text for delta in self)
+
+    @staticmethod
+    def of(continuation: ChatHistory) -> "ReplyStream":
+        """Makes a stream from a reply that is already complete."""
+        def deltas():
+            yield from ReplyStream.message_deltas(continuation)
+            return continuation
+        return ReplyStream(deltas())
+
+    @staticmethod
+    def message_deltas(continuation: ChatHistory) -> Iterator[MessageEvent]:
+        """Yields the messages of a complete continuation as a single delta."""
+        messages = continuation.get_messages()
+        if messages:
+            yield MessageEvent(originator=messages[-1].originator, role=Role.assistant,
+                               message_text='\n\n'.join(m.message_text for m in messages))
@@ -1,29 +1,134 @@
+import asyncio
 from importlib import import_module
-from typing import Any, Tuple, Optional
+from importlib.metadata import entry_points
+from typing import Any, Tuple, Optional, Callable, Generator
 
+from knowledge_net.chat.chat_event import MessageEvent
 from knowledge_net.chat.chat_history import ChatHistory
+from knowledge_net.chat.reply_stream import ReplyStream
 
 
 class CommShell:
     """
     All-static class serving as an interface to the communication shell.
 
-    The class dispatches requests based on the protocol used.
+    The class dispatches requests based on the protocol used. The class handling a protocol is looked up once and
+    kept in a registry, see :code:`handler`.
     """
 
+    ENTRY_POINT_GROUP = "knowledge_net.comm_shell"
+    """Entry point group under which installed packages can declare protocol handlers"""
+
+    _handlers: dict[str, type] = {}
+
     @staticmethod
-    def reply(kb_name: str, chat_history: ChatHistory, protocol: str, protocol_details: Any, timeout: int = None) -> \
-            Tuple[ChatHistory, Optional[str]]:
-        """Calls the reply method on the class implementing the protocol.
+    def register(protocol: str) -> Callable[[type], type]:
+        """Class decorator registering the class as the handler of the protocol.
+
+        Example::
+
+            @CommShell.register("nostr")
+            class NostrShell:
+                @staticmethod
+                def reply(kb_name, chat_history, protocol_details, timeout=None):
+                    ...
+        """
+        def decorator(c: type) -> type:
+            CommShell._handlers[protocol.lower()] = c
+            return c
+        return decorator
+
+    @staticmethod
+    def handler(protocol: str) -> type:
+        """Returns the class implementing the protocol.
 
-        We rely on the convention that modules are called :code:`comm_shell_<protocol_name>`,
-        for example :code:`comm_shell_http` and classes :code:`CommShell<Protocol_name>`, for example
-        :code:`CommShellHttp`. The class should have a static :code:`reply` method.
+        Classes registered with :code:`register` are used directly. Otherwise, we look for an entry point named
+        after the protocol in the group :code:`knowledge_net.comm_shell`, and finally rely on the convention that
+        modules are called :code:`comm_shell_<protocol_name>`, for example :code:`comm_shell_http` and classes
+        :code:`CommShell<Protocol_name>`, for example :code:`CommShellHttp`. The result is cached.
+        Raises ValueError if no handler is found.
         """
+        key = protocol.lower()
+        c = CommShell._handlers.get(key)
+        if c is None:
+            c = CommShell._resolve(key)
+            CommShell._handlers[key] = c
+        return c
+
+    @staticmethod
+    def _resolve(protocol: str) -> type:
+        """Finds the class implementing the protocol from entry points or by naming convention."""
+        eps = entry_points()
+        group = eps.select(group=CommShell.ENTRY_POINT_GROUP) if hasattr(eps, 'select') \
+            else eps.get(CommShell.ENTRY_POINT_GROUP, [])
+        for ep in group:
+            if ep.name.lower() == protocol:
+                return ep.load()
 
-        module_name = "knowledge_net.comm_shell.comm_shell_" + protocol.lower()
-        module = import_module(module_name)
+        module_name = "knowledge_net.comm_shell.comm_shell_" + protocol
+        try:
+            module = import_module(module_name)
+        except ModuleNotFoundError as e:
+            if e.name != module_name:
+                raise
+            raise ValueError(f"Unknown protocol {protocol}") from e
+        if protocol in CommShell._handlers:
+            return CommShell._handlers[protocol]
         class_name = "CommShell" + protocol.capitalize()
-        c = getattr(module, class_name)
-        reply_method = getattr(c, "reply")
-        return reply_method(kb_name, chat_history, protocol_details)
+        if not hasattr(module, class_name):
+            raise ValueError(f"Module {module_name} has no class {class_name}")
+        return getattr(module, class_name)
+
+    @staticmethod
+    def reply(kb_name: str, chat_history: ChatHistory, protocol: str, protocol_details: Any,
+              timeout: Optional[float] = None) -> Tuple[ChatHistory, Optional[str]]:
+        """Calls the reply method on the class implementing the protocol.
+
+        The class should have a static :code:`reply` method. The time out is passed on to the protocol, which should
+        give up waiting for the reply after that many seconds.
+        """
+        return CommShell.handler(protocol).reply(kb_name, chat_history, protocol_details, timeout=timeout)
+
+    @staticmethod
+    def reply_batch(kb_name: str, chat_histories: list[ChatHistory], protocol: str, protocol_details: Any,
+                    timeout: Optional[float] = None) -> list[Tuple[ChatHistory, Optional[str]]]:
+        """Sends many chat histories through the class implementing the protocol.
+
+        Classes supporting batches have a static :code:`reply_batch` method taking a list of chat histories and
+        returning the continuation and error for each. For other classes, :code:`reply` is called for each chat
+        history.
+        """
+        c = CommShell.handler(protocol)
+        if hasattr(c, 'reply_batch'):
+            return c.reply_batch(kb_name, chat_histories, protocol_details, timeout=timeout)
+        return [c.reply(kb_name, h, protocol_details, timeout=timeout) for h in chat_histories]
+
+    @staticmethod
+    async def areply(kb_name: str, chat_history: ChatHistory, protocol: str, protocol_details: Any,
+                     timeout: Optional[float] = None) -> Tuple[ChatHistory, Optional[str]]:
+        """Asynchronous version of :code:`reply`.
+
+        Classes with a static :code:`areply` coroutine method are awaited directly. For other classes, :code:`reply`
+        runs in a worker thread.
+        """
+        c = CommShell.handler(protocol)
+        if hasattr(c, 'areply'):
+            return await c.areply(kb_name, chat_history, protocol_details, timeout=timeout)
+        return await asyncio.to_thread(c.reply, kb_name, chat_history, protocol_details, timeout=timeout)
+
+    @staticmethod
+    def reply_stream(kb_name: str, chat_history: ChatHistory, protocol: str, protocol_details: Any,
+                     timeout: Optional[float] = None) \
+            -> Generator[MessageEvent, None, Tuple[ChatHistory, Optional[str]]]:
+        """Streams the reply through the class implementing the protocol.
+
+        Classes supporting streaming have a static :code:`reply_stream` generator method with the same arguments as
+        :code:`reply`, yielding message deltas and returning the continuation and error. For other classes, the
+        reply is delivered in one piece.
+        """
+        c = CommShell.handler(protocol)
+        if hasattr(c, 'reply_stream'):
+            return (yield from c.reply_stream(kb_name, chat_history, protocol_details, timeout=timeout))
+        continuation, error = c.reply(kb_name, chat_history, protocol_details, timeout=timeout)
+        yield from ReplyStream.message_deltas(continuation)
+        return continuation, error
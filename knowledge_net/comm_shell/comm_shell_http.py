@@ -1,11 +1,32 @@
+import asyncio
+import select
 import socketserver
+import threading
+import time
 import warnings
-from typing import Any, Tuple, Optional
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Tuple, Optional, Generator
 import http.server
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from knowledge_net.chat.chat_codec import ChatCodec
+from knowledge_net.chat.chat_event import MessageEvent
 from knowledge_net.chat.chat_history import ChatHistory
+from knowledge_net.chat.reply_stream import ReplyStream
+from knowledge_net.comm_shell.comm_shell import CommShell
+from knowledge_net.comm_shell.http_compression import HttpCompression, BodyTooLargeError
+from knowledge_net.comm_shell.http_sessions import SessionCache, SessionTracker
+from knowledge_net.knowledgebase.deadline import Deadline
 from knowledge_net.knowledgebase.knowledgebase import Knowledgebase
 
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
+
 
 class NodeHTTPHandler(http.server.BaseHTTPRequestHandler):
     """Handles incoming HTTP requests for the HTTP communication shell.
@@ -18,54 +39,598 @@ class NodeHTTPHandler(http.server.BaseHTTPRequestHandler):
 
     The response has the same format as the "history" and contains the
     continuation of the chat.
+
+    A request can also carry a "session" property, with an "id" and a "base_length". The "chat_history" then
+    only holds the events following the first "base_length" events of the session's previous request. If the
+    server doesn't have those, it answers 409 Conflict and the caller resends the full chat history,
+    see :code:`SessionCache`.
+
+    If the chat history ends with a call event with a time out, the knowledge base replies under that deadline,
+    so that its own calls to other knowledge bases don't outlast the caller's patience.
+
+    With the property "stream": true, the reply is streamed as server-sent events, see :code:`respond_stream`.
+
+    A batch request has a "chat_histories" list instead of a "chat_history". The response is a json object whose
+    "continuations" list holds the continuation of each chat history, in order.
+
+    Connections are kept alive between requests (HTTP/1.1) and closed after :code:`timeout` idle seconds, or as soon
+    as another connection is waiting for a worker of a :code:`PooledTCPServer`.
+    Request and response bodies can be compressed, see :code:`HttpCompression`.
     """
 
+    protocol_version = "HTTP/1.1"
+    timeout = 5
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        server = self.server
+        if not isinstance(server, PooledTCPServer):
+            super().handle()
+            return
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and server.wait_for_request(self.connection, self.timeout):
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        server = self.server
+        if not isinstance(server, PooledTCPServer):
+            super().handle_one_request()
+            return
+        if not server.start_request(self.request):
+            self.close_connection = True
+            self.wfile.write(PooledTCPServer.OVERLOADED_RESPONSE)
+            warnings.warn(f"Server overloaded, rejected request from {self.client_address}")
+            return
+        try:
+            super().handle_one_request()
+        finally:
+            server.end_request()
+
     def do_POST(self):
         content_length = int(self.headers['Content-Length'])
+        if content_length > HttpCompression.max_body_size:
+            self.respond_too_large()
+            return
         post_data = self.rfile.read(content_length)
 
         try:
-            knowledgebase, chat_history, error = Knowledgebase.kb_and_history_from_json(post_data.decode('utf-8'))
+            data = NodeHTTPHandler.decode(post_data, self.headers['Content-Encoding'])
+            if 'chat_histories' in data:
+                knowledgebase, chat_histories, error = Knowledgebase.kb_and_histories_from_dict(data)
+            else:
+                knowledgebase, chat_history, error = NodeHTTPHandler.parse_chat_request(data)
+        except BodyTooLargeError:
+            self.respond_too_large()
+            return
         except ValueError:
             self.respond_bad_request('POST')
             return
+        if 'chat_histories' in data:
+            self.respond(200, 'application/json', NodeHTTPHandler.reply_batch(knowledgebase, chat_histories, error))
+            return
+        if chat_history is None:
+            self.respond_session_miss()
+            return
+
+        if data.get('stream', False):
+            with Deadline.scope(chat_history.get_call_time_out()):
+                self.respond_stream(ReplyStream.of(ChatHistory.error(chat_history, error)) if error
+                                    else knowledgebase.reply_stream(chat_history))
+            return
 
         if error:
-            continuation = ChatHistory.error(chat_history, error).as_json()
+            continuation = ChatHistory.error(chat_history, error)
         else:
-            continuation = knowledgebase.reply(chat_history).as_json()
+            with Deadline.scope(chat_history.get_call_time_out()):
+                continuation = knowledgebase.reply(chat_history)
+        self.respond(200, 'application/json', continuation.as_json_bytes())
 
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Content-length', str(len(continuation)))
-        self.end_headers()
+    @staticmethod
+    def decode(post_data: bytes, content_encoding: Optional[str]) -> dict[str, Any]:
+        """Decodes a request body. Raises ValueError if it isn't a json object."""
+        data = ChatCodec.loads(HttpCompression.decompress(post_data, content_encoding))
+        if not isinstance(data, dict):
+            raise ValueError("Expected a json object")
+        return data
+
+    @staticmethod
+    def parse_chat_request(data: dict[str, Any]) -> Tuple[Optional[Knowledgebase], Optional[ChatHistory], str]:
+        """Returns the knowledge base, chat history and error of a decoded request.
 
-        self.wfile.write(continuation.encode('utf-8'))
+        With the session protocol, the chat history is None if the session is unknown. Raises ValueError if the
+        request is malformed.
+        """
+        knowledgebase, chat_history, error = Knowledgebase.kb_and_history_from_dict(data)
+        if 'session' in data:
+            chat_history = SessionCache.resume(data['knowledgebase'], data['session'], chat_history)
+        return knowledgebase, chat_history, error
+
+    @staticmethod
+    def reply_batch(knowledgebase: Optional[Knowledgebase], chat_histories: list[ChatHistory], error: str) -> bytes:
+        """Replies to a batch request, returns the json response listing the continuations in order."""
+        if error:
+            continuations = [ChatHistory.error(h, error) for h in chat_histories]
+        else:
+            with Deadline.scope(chat_histories[0].get_call_time_out() if chat_histories else 0):
+                continuations = knowledgebase.reply_batch(chat_histories)
+        return ChatCodec.dumps({'continuations': [c.to_dict_list() for c in continuations]})
 
     def do_GET(self):
         self.respond_bad_request('GET')
 
-    def respond_bad_request(self, request_type: str = 'GET'):
-        self.send_response(400)
-        self.send_header('Content-type', 'text/html')
+    def respond(self, status: int, content_type: str, body: bytes):
+        """Sends a response, compressed if the client accepts it and the body is large enough."""
+        body, encoding = HttpCompression.compress(body, HttpCompression.choose(self.headers['Accept-Encoding']))
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Accept-Encoding', HttpCompression.accept_encoding_header(
+            HttpCompression.supported_encodings()))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond_stream(self, stream: ReplyStream):
+        """Sends a streamed reply as server-sent events in a chunked response.
+
+        Each message delta is sent as a "delta" event whose data is the json representation of the delta. The
+        stream ends with a "continuation" event whose data is the continuation of the chat history.
+        """
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Accept-Encoding', HttpCompression.accept_encoding_header(
+            HttpCompression.supported_encodings()))
         self.end_headers()
-        self.wfile.write(bytes("Bad Request", "utf-8"))
+        for delta in stream:
+            self.write_chunk(NodeHTTPHandler.sse_event(b"delta", ChatCodec.dumps(ChatCodec.event_to_dict(delta))))
+        self.write_chunk(NodeHTTPHandler.sse_event(b"continuation", stream.continuation.as_json_bytes()))
+        self.wfile.write(b"0\r\n\r\n")
+
+    @staticmethod
+    def sse_event(event: bytes, data: bytes) -> bytes:
+        return b"event: " + event + b"\ndata: " + data + b"\n\n"
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def respond_session_miss(self):
+        self.respond(409, 'text/html', bytes("Unknown session, send the full chat history", "utf-8"))
+
+    def respond_too_large(self):
+        """Answers 413 and closes the connection, since the request body may not have been read."""
+        self.close_connection = True
+        self.respond(413, 'text/html', b"Payload Too Large")
+        warnings.warn(f"Too large POST request from {self.client_address}")
+
+    def respond_bad_request(self, request_type: str = 'GET'):
+        self.respond(400, 'text/html', bytes("Bad Request", "utf-8"))
         warnings.warn(f"Bad {request_type} request from {self.client_address}")
 
 
+class HttpSessionPool:
+    """All-static class keeping one keep-alive session per remote URL.
+
+    Sessions hold a pool of open connections, so that repeated calls to the same knowledge base don't pay for a new
+    TCP (and TLS) handshake. Failed connection attempts are retried with exponential backoff by :code:`post`, within
+    the time out of the call. Requests that reached the server are not retried.
+    """
+
+    pool_size: int = 10
+    """Maximum number of open connections per URL"""
+
+    retries: int = 3
+    """Number of retries on connection errors"""
+
+    backoff_factor: float = 0.2
+    """Retries wait backoff_factor * 2 ** (retry number - 1) seconds"""
+
+    _sessions: dict[str, requests.Session] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def configure(pool_size: Optional[int] = None, retries: Optional[int] = None,
+                  backoff_factor: Optional[float] = None):
+        """Changes the pool settings. Applies to sessions created after the call."""
+        if pool_size is not None:
+            HttpSessionPool.pool_size = pool_size
+        if retries is not None:
+            HttpSessionPool.retries = retries
+        if backoff_factor is not None:
+            HttpSessionPool.backoff_factor = backoff_factor
+
+    @staticmethod
+    def session(url: str) -> requests.Session:
+        """Returns the session for the URL, creating it on first use."""
+        session = HttpSessionPool._sessions.get(url)
+        if session is None:
+            with HttpSessionPool._lock:
+                session = HttpSessionPool._sessions.get(url)
+                if session is None:
+                    session = HttpSessionPool._make_session()
+                    HttpSessionPool._sessions[url] = session
+        return session
+
+    @staticmethod
+    def post(url: str, timeout: Optional[float], **kwargs: Any) -> requests.Response:
+        """Posts to the URL, retrying failed connection attempts.
+
+        Each attempt gets the time left of :code:`timeout`, so that retries never make the call outlast it.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        for attempt in range(HttpSessionPool.retries + 1):
+            remaining = None if end is None else end - time.monotonic()
+            try:
+                return HttpSessionPool.session(url).post(url=url, timeout=remaining, **kwargs)
+            except requests.ConnectionError as e:
+                delay = HttpSessionPool.backoff_factor * 2 ** attempt
+                if attempt == HttpSessionPool.retries or not HttpSessionPool.is_connect_error(e) or \
+                        end is not None and time.monotonic() + delay >= end:
+                    raise
+                time.sleep(delay)
+
+    @staticmethod
+    def is_connect_error(error: requests.ConnectionError) -> bool:
+        """True if the request failed before reaching the server, so that it can safely be retried."""
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(error, requests.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+    @staticmethod
+    def close_all():
+        """Closes all sessions and their connections."""
+        with HttpSessionPool._lock:
+            for session in HttpSessionPool._sessions.values():
+                session.close()
+            HttpSessionPool._sessions = {}
+
+    @staticmethod
+    def _make_session() -> requests.Session:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HttpSessionPool.pool_size, max_retries=0)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+
+class AsyncHttpSessionPool:
+    """All-static class keeping one aiohttp session per event loop for asynchronous calls.
+
+    aiohttp sessions are bound to the event loop they were created in. Each session keeps up to
+    :code:`connections_per_host` open connections per host and retries failed connection attempts like
+    :code:`HttpSessionPool`. Responses are decompressed by :code:`HttpCompression`.
+    """
+
+    connections_per_host: int = 100
+    """Maximum number of concurrent connections per host, 0 for no limit. Separate from
+    :code:`HttpSessionPool.pool_size`, since one event loop serves many more concurrent calls than a thread pool"""
+
+    _sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = \
+        weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def session() -> "aiohttp.ClientSession":
+        """Returns the session for the running event loop, creating it on first use."""
+        loop = asyncio.get_running_loop()
+        session = AsyncHttpSessionPool._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=AsyncHttpSessionPool.connections_per_host)
+            session = aiohttp.ClientSession(connector=connector, auto_decompress=False)
+            AsyncHttpSessionPool._sessions[loop] = session
+        return session
+
+    @staticmethod
+    def configure(connections_per_host: Optional[int] = None):
+        """Changes the session settings. Applies to sessions created after the call."""
+        if connections_per_host is not None:
+            AsyncHttpSessionPool.connections_per_host = connections_per_host
+
+    @staticmethod
+    async def close():
+        """Closes the session of the running event loop."""
+        session = AsyncHttpSessionPool._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    @staticmethod
+    async def post(url: str, data: bytes, headers: dict[str, str], timeout: Optional[float]) -> Tuple[int, Any, bytes]:
+        """Posts the data and returns the status, headers and decompressed body of the response.
+
+        Each attempt gets the time left of :code:`timeout`, like :code:`HttpSessionPool.post`.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        for attempt in range(HttpSessionPool.retries + 1):
+            client_timeout = aiohttp.ClientTimeout(total=None if end is None else end - time.monotonic())
+            try:
+                async with AsyncHttpSessionPool.session().post(url, data=data, headers=headers,
+                                                               timeout=client_timeout) as response:
+                    body = await response.read()
+                    body = HttpCompression.decompress(body, response.headers.get('Content-Encoding'))
+                    return response.status, response.headers, body
+            except aiohttp.ClientConnectorError:
+                delay = HttpSessionPool.backoff_factor * 2 ** attempt
+                if attempt == HttpSessionPool.retries or end is not None and time.monotonic() + delay >= end:
+                    raise
+                await asyncio.sleep(delay)
+
+
+@CommShell.register("http")
 class CommShellHttp:
     """Handles replies over HTTP."""
 
+    SESSION_MISS = "Session unknown to the remote knowledge base"
+
     @staticmethod
-    def reply(kb_name: str, chat_history: ChatHistory, protocol_details: Any, timeout: int = None) \
+    def reply(kb_name: str, chat_history: ChatHistory, protocol_details: Any, timeout: Optional[float] = None) \
             -> Tuple[ChatHistory, Optional[str]]:
+        """Posts the chat history to the remote knowledge base and returns the continuation.
+
+        Connection failures, error responses and replies taking longer than :code:`timeout` seconds are returned as
+        errors. With :code:`"sessions": true` in the protocol details, only the events the remote knowledge base
+        hasn't seen are sent. The server must support the session protocol, see :code:`NodeHTTPHandler`.
+        """
         if 'url' not in protocol_details:
             raise ValueError("Missing required 'url' in protocol details")
-        headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
+        url = protocol_details['url']
 
-        json_data = Knowledgebase.kb_and_history_as_dict(kb_name, chat_history)
-        response = requests.post(url=protocol_details['url'], json=json_data, headers=headers, timeout=timeout)
-        return ChatHistory.from_json(response.content.decode('utf-8')), None
+        if not protocol_details.get('sessions', False):
+            json_data = Knowledgebase.kb_and_history_as_json_bytes(kb_name, chat_history)
+            return CommShellHttp._post(url, json_data, timeout)
+
+        base_length = SessionTracker.known_length(url, kb_name, chat_history)
+        continuation, error = CommShellHttp._post(url, CommShellHttp._session_json(kb_name, chat_history, base_length),
+                                                  timeout)
+        if error == CommShellHttp.SESSION_MISS and base_length > 0:
+            continuation, error = CommShellHttp._post(url, CommShellHttp._session_json(kb_name, chat_history, 0),
+                                                      timeout)
+        if error:
+            SessionTracker.forget(url, kb_name, chat_history)
+        else:
+            SessionTracker.record_sent(url, kb_name, chat_history)
+        return continuation, error
+
+    @staticmethod
+    def reply_batch(kb_name: str, chat_histories: list[ChatHistory], protocol_details: Any,
+                    timeout: Optional[float] = None) -> list[Tuple[ChatHistory, Optional[str]]]:
+        """Posts all chat histories in one request and returns the continuation and error for each, in order.
+
+        If the request fails, every chat history gets the same error.
+        """
+        if 'url' not in protocol_details:
+            raise ValueError("Missing required 'url' in protocol details")
+        url = protocol_details['url']
+
+        json_data = Knowledgebase.kb_and_histories_as_json_bytes(kb_name, chat_histories)
+        try:
+            response = CommShellHttp._send(url, json_data, timeout)
+        except requests.Timeout:
+            error = f"No reply within {timeout} seconds"
+        except requests.ConnectionError:
+            error = f"Could not connect to {url}"
+        else:
+            if response.status_code == 200:
+                continuations = ChatCodec.loads(response.content)['continuations']
+                return [(ChatHistory.from_dict_list(c), None) for c in continuations]
+            error = f"HTTP error {response.status_code} from {url}"
+        return [(ChatHistory(), error) for _ in chat_histories]
+
+    @staticmethod
+    async def areply(kb_name: str, chat_history: ChatHistory, protocol_details: Any,
+                     timeout: Optional[float] = None) -> Tuple[ChatHistory, Optional[str]]:
+        """Asynchronous version of :code:`reply`.
+
+        Uses aiohttp if it is installed, otherwise runs :code:`reply` in a worker thread.
+        """
+        if aiohttp is None:
+            return await asyncio.to_thread(CommShellHttp.reply, kb_name, chat_history, protocol_details, timeout)
+        if 'url' not in protocol_details:
+            raise ValueError("Missing required 'url' in protocol details")
+        url = protocol_details['url']
+
+        if not protocol_details.get('sessions', False):
+            json_data = Knowledgebase.kb_and_history_as_json_bytes(kb_name, chat_history)
+            return await CommShellHttp._apost(url, json_data, timeout)
+
+        base_length = SessionTracker.known_length(url, kb_name, chat_history)
+        continuation, error = await CommShellHttp._apost(
+            url, CommShellHttp._session_json(kb_name, chat_history, base_length), timeout)
+        if error == CommShellHttp.SESSION_MISS and base_length > 0:
+            continuation, error = await CommShellHttp._apost(
+                url, CommShellHttp._session_json(kb_name, chat_history, 0), timeout)
+        if error:
+            SessionTracker.forget(url, kb_name, chat_history)
+        else:
+            SessionTracker.record_sent(url, kb_name, chat_history)
+        return continuation, error
+
+    @staticmethod
+    def _session_json(kb_name: str, chat_history: ChatHistory, base_length: int) -> bytes:
+        """Encodes a session protocol request sending the events after the first base_length events."""
+        return ChatCodec.dumps({'knowledgebase': kb_name,
+                                'chat_history': chat_history.to_dict_list(start=base_length),
+                                'session': {'id': chat_history.get_session_id(), 'base_length': base_length}})
+
+    @staticmethod
+    def reply_stream(kb_name: str, chat_history: ChatHistory, protocol_details: Any, timeout: Optional[float] = None) \
+            -> Generator[MessageEvent, None, Tuple[ChatHistory, Optional[str]]]:
+        """Posts the chat history asking for a streamed reply, yields the message deltas as they arrive.
+
+        Returns the continuation and error like :code:`reply`. The full chat history is sent, also with sessions.
+        """
+        if 'url' not in protocol_details:
+            raise ValueError("Missing required 'url' in protocol details")
+        url = protocol_details['url']
+
+        json_data = ChatCodec.dumps(dict(Knowledgebase.kb_and_history_as_dict(kb_name, chat_history), stream=True))
+        try:
+            response = CommShellHttp._send(url, json_data, timeout, accept='text/event-stream', stream=True)
+        except requests.Timeout:
+            return ChatHistory(), f"No reply within {timeout} seconds"
+        except requests.ConnectionError:
+            return ChatHistory(), f"Could not connect to {url}"
+
+        with response:
+            if response.status_code != 200:
+                return ChatHistory(), f"HTTP error {response.status_code} from {url}"
+            event = None
+            try:
+                for line in response.iter_lines():
+                    if line.startswith(b"event:"):
+                        event = line[len(b"event:"):].strip()
+                    elif line.startswith(b"data:"):
+                        data = line[len(b"data:"):].strip()
+                        if event == b"delta":
+                            yield ChatCodec.event_from_dict(ChatCodec.loads(data))
+                        elif event == b"continuation":
+                            return ChatHistory.from_json(data), None
+            except requests.RequestException:
+                return ChatHistory(), f"Stream from {url} interrupted"
+        return ChatHistory(), f"Stream from {url} ended without a continuation"
+
+    @staticmethod
+    def _send(url: str, json_data: bytes, timeout: Optional[float], accept: str = 'application/json',
+              stream: bool = False) -> requests.Response:
+        """Posts the json data, compressed if the server accepts it."""
+        headers = {'Content-type': 'application/json', 'Accept': accept,
+                   'Accept-Encoding': HttpCompression.accept_encoding_header(HttpCompression.response_encodings())}
+        json_data, encoding = HttpCompression.compress(json_data, HttpCompression.request_encoding(url))
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        response = HttpSessionPool.post(url, timeout, data=json_data, headers=headers, stream=stream)
+        HttpCompression.record_server_encodings(url, response.headers.get('Accept-Encoding'))
+        return response
+
+    @staticmethod
+    def _post(url: str, json_data: bytes, timeout: Optional[float]) -> Tuple[ChatHistory, Optional[str]]:
+        """Posts the json data and decodes the continuation in the response."""
+        try:
+            response = CommShellHttp._send(url, json_data, timeout)
+        except requests.Timeout:
+            return ChatHistory(), f"No reply within {timeout} seconds"
+        except requests.ConnectionError:
+            return ChatHistory(), f"Could not connect to {url}"
+        if response.status_code == 409:
+            return ChatHistory(), CommShellHttp.SESSION_MISS
+        if response.status_code != 200:
+            return ChatHistory(), f"HTTP error {response.status_code} from {url}"
+        return ChatHistory.from_json(response.content), None
+
+    @staticmethod
+    async def _apost(url: str, json_data: bytes, timeout: Optional[float]) -> Tuple[ChatHistory, Optional[str]]:
+        """Asynchronous version of :code:`_post`."""
+        headers = {'Content-type': 'application/json', 'Accept': 'application/json',
+                   'Accept-Encoding': HttpCompression.accept_encoding_header(HttpCompression.supported_encodings())}
+        json_data, encoding = HttpCompression.compress(json_data, HttpCompression.request_encoding(url))
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        try:
+            status, response_headers, body = await AsyncHttpSessionPool.post(url, json_data, headers, timeout)
+        except asyncio.TimeoutError:
+            return ChatHistory(), f"No reply within {timeout} seconds"
+        except aiohttp.ClientError:
+            return ChatHistory(), f"Could not connect to {url}"
+        HttpCompression.record_server_encodings(url, response_headers.get('Accept-Encoding'))
+        if status == 409:
+            return ChatHistory(), CommShellHttp.SESSION_MISS
+        if status != 200:
+            return ChatHistory(), f"HTTP error {status} from {url}"
+        return ChatHistory.from_json(body), None
+
+
+class PooledTCPServer(socketserver.TCPServer):
+    """TCP server handling requests on a bounded pool of worker threads.
+
+    At most :code:`max_in_flight` requests are accepted at a time, counting both the requests being handled and
+    the new connections waiting for a worker. Further requests are answered with 503 Service Unavailable right away.
+    Slots are taken per request, not per connection: a keep-alive connection between requests holds no slot, and
+    gives up its worker as soon as another connection is waiting for one, see :code:`wait_for_request`.
+    Every request is parsed into its own chat history, so workers share nothing but the knowledge bases.
+    """
+
+    IDLE_POLL_INTERVAL = 0.05
+    """Seconds between checks for waiting connections while a keep-alive connection is idle"""
+
+    allow_reuse_address = True
+    OVERLOADED_RESPONSE = b"HTTP/1.0 503 Service Unavailable\r\n" \
+                          b"Content-type: text/html\r\nContent-length: 19\r\nRetry-After: 1\r\n\r\n" \
+                          b"Service Unavailable"
+
+    def __init__(self, server_address, request_handler_class, workers: int, max_in_flight: int):
+        super().__init__(server_address, request_handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="knowledge-net-worker")
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.waiting = 0
+        self._accepted = set()
+        self._lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        # The slot taken here is used by the first request of the connection
+        if not self.in_flight.acquire(blocking=False):
+            self.reject_request(request, client_address)
+            return
+        with self._lock:
+            self._accepted.add(request)
+            self.waiting += 1
+        self.executor.submit(self.process_request_in_worker, request, client_address)
+
+    def process_request_in_worker(self, request, client_address):
+        with self._lock:
+            self.waiting -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._lock:
+                unused = request in self._accepted
+                self._accepted.discard(request)
+            if unused:
+                self.in_flight.release()
+
+    def start_request(self, request) -> bool:
+        """Takes a slot for a request on the connection, the one taken when it was accepted for the first request.
+
+        Returns False if the server is full.
+        """
+        with self._lock:
+            if request in self._accepted:
+                self._accepted.discard(request)
+                return True
+        return self.in_flight.acquire(blocking=False)
+
+    def end_request(self):
+        self.in_flight.release()
+
+    def wait_for_request(self, connection, timeout: Optional[float]) -> bool:
+        """Waits for the next request on a keep-alive connection.
+
+        Returns False if the connection stays idle for :code:`timeout` seconds, or while another connection is
+        waiting for a worker, so that idle connections don't keep workers from new ones.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            readable, _, _ = select.select([connection], [], [], PooledTCPServer.IDLE_POLL_INTERVAL)
+            if readable:
+                return True
+            if self.waiting > 0 or end is not None and time.monotonic() >= end:
+                return False
+
+    def reject_request(self, request, client_address):
+        """Answers 503 without reading the request."""
+        try:
+            request.sendall(self.OVERLOADED_RESPONSE)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+        warnings.warn(f"Server overloaded, rejected request from {client_address}")
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
 
 
 class Server:
@@ -73,9 +638,120 @@ class Server:
 
     DEFAULT_PORT = 8000
 
+    DEFAULT_WORKERS = 8
+    """Default number of requests handled at the same time"""
+
+    DEFAULT_QUEUE_SIZE = 16
+    """Default number of requests waiting for a worker before the server answers 503"""
+
     @staticmethod
-    def serve(port: int = None):
+    def serve(port: int = None, workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE):
+        """Serves the public knowledge bases.
+
+        Requests are handled concurrently by :code:`workers` threads. Up to :code:`queue_size` more requests wait
+        for a free worker, beyond that the server answers 503 Service Unavailable.
+        """
         port = port or Server.DEFAULT_PORT
-        with socketserver.TCPServer(("", port), NodeHTTPHandler) as httpd:
+        with PooledTCPServer(("", port), NodeHTTPHandler, workers=workers, max_in_flight=workers + queue_size) \
+                as httpd:
             print("Serving at port", port)
             httpd.serve_forever()
+
+
+class AsyncServer:
+    """Runs a Knowledge Net HTTP server on an asyncio event loop.
+
+    Requests are answered with :code:`Knowledgebase.areply`, so a single process can serve many conversations
+    waiting on remote knowledge bases or language models at the same time. The server speaks the same protocol as
+    :code:`Server`, including sessions and compression. Streamed replies are sent in one piece. Requires aiohttp.
+    """
+
+    DEFAULT_MAX_IN_FLIGHT = 256
+    """Default number of requests handled at the same time before the server answers 503"""
+
+    @staticmethod
+    def serve(port: int = None, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+        """Serves the public knowledge bases until interrupted."""
+        asyncio.run(AsyncServer.serve_async(port or Server.DEFAULT_PORT, max_in_flight))
+
+    @staticmethod
+    async def serve_async(port: int, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+        if aiohttp is None:
+            raise ImportError("AsyncServer requires aiohttp")
+        runner = await AsyncServer.start(port, max_in_flight)
+        print("Serving at port", port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    @staticmethod
+    async def start(port: int, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> "web.AppRunner":
+        """Starts serving in the running event loop. Stop the server with :code:`cleanup` on the returned runner."""
+        in_flight = 0
+
+        async def handle(request: "web.Request") -> "web.Response":
+            nonlocal in_flight
+            if in_flight >= max_in_flight:
+                warnings.warn(f"Server overloaded, rejected request from {request.remote}")
+                return web.Response(status=503, text="Service Unavailable", headers={'Retry-After': '1'})
+            in_flight += 1
+            try:
+                return await AsyncServer.handle_post(request)
+            finally:
+                in_flight -= 1
+
+        async def handle_get(request: "web.Request") -> "web.Response":
+            warnings.warn(f"Bad GET request from {request.remote}")
+            return AsyncServer.respond(request, 400, 'text/html', b"Bad Request")
+
+        app = web.Application(client_max_size=HttpCompression.max_body_size)
+        app.router.add_post('/{tail:.*}', handle)
+        app.router.add_get('/{tail:.*}', handle_get)
+        runner = web.AppRunner(app, auto_decompress=False, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, port=port).start()
+        return runner
+
+    @staticmethod
+    async def handle_post(request: "web.Request") -> "web.Response":
+        try:
+            data = NodeHTTPHandler.decode(await request.read(), request.headers.get('Content-Encoding'))
+            if 'chat_histories' in data:
+                knowledgebase, chat_histories, error = Knowledgebase.kb_and_histories_from_dict(data)
+            else:
+                knowledgebase, chat_history, error = NodeHTTPHandler.parse_chat_request(data)
+        except BodyTooLargeError:
+            warnings.warn(f"Too large POST request from {request.remote}")
+            return AsyncServer.respond(request, 413, 'text/html', b"Payload Too Large")
+        except ValueError:
+            warnings.warn(f"Bad POST request from {request.remote}")
+            return AsyncServer.respond(request, 400, 'text/html', b"Bad Request")
+        if 'chat_histories' in data:
+            body = await asyncio.to_thread(NodeHTTPHandler.reply_batch, knowledgebase, chat_histories, error)
+            return AsyncServer.respond(request, 200, 'application/json', body)
+        if chat_history is None:
+            return AsyncServer.respond(request, 409, 'text/html', b"Unknown session, send the full chat history")
+
+        if error:
+            continuation = ChatHistory.error(chat_history, error)
+        else:
+            with Deadline.scope(chat_history.get_call_time_out()):
+                continuation = await knowledgebase.areply(chat_history)
+
+        if data.get('stream', False):
+            events = [NodeHTTPHandler.sse_event(b"delta", ChatCodec.dumps(ChatCodec.event_to_dict(delta)))
+                      for delta in ReplyStream.message_deltas(continuation)]
+            events.append(NodeHTTPHandler.sse_event(b"continuation", continuation.as_json_bytes()))
+            return AsyncServer.respond(request, 200, 'text/event-stream', b"".join(events))
+        return AsyncServer.respond(request, 200, 'application/json', continuation.as_json_bytes())
+
+    @staticmethod
+    def respond(request: "web.Request", status: int, content_type: str, body: bytes) -> "web.Response":
+        """Makes a response, compressed like in :code:`NodeHTTPHandler.respond`."""
+        body, encoding = HttpCompression.compress(body, HttpCompression.choose(request.headers.get('Accept-Encoding')))
+        headers = {'Content-Type': content_type, 'Accept-Encoding': HttpCompression.accept_encoding_header(
+            HttpCompression.supported_encodings())}
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return web.Response(status=status, body=body, headers=headers)
@@ -3,11 +3,13 @@ from typing import Any, Tuple, Optional
 
 from knowledge_net.chat.chat_event import Role, MessageEvent
 from knowledge_net.chat.chat_history import ChatHistory
+from knowledge_net.comm_shell.comm_shell import CommShell
 
 
+@CommShell.register("mock")
 class CommShellMock:
     @staticmethod
-    def reply(kb_name: str, chat_history: ChatHistory, protocol_details: Any, timeout: int = None) -> \
+    def reply(kb_name: str, chat_history: ChatHistory, protocol_details: Any, timeout: Optional[float] = None) -> \
             Tuple[ChatHistory, Optional[str]]:
         message = random.choice(
             [
@@ -0,0 +1,134 @@
+import gzip
+import io
+import threading
+from typing import Optional, Tuple
+
+import urllib3
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class BodyTooLargeError(ValueError):
+    """Raised when a body is larger than :code:`HttpCompression.max_body_size`, compressed or not."""
+
+
+class HttpCompression:
+    """All-static class compressing HTTP bodies exchanged between knowledge bases.
+
+    Bodies are compressed with zstd if the zstandard package is installed, otherwise with gzip. Responses are
+    compressed according to the Accept-Encoding header of the request. Servers list the encodings they accept in
+    an Accept-Encoding header in their responses; the caller remembers them and compresses later requests to
+    the same URL. Bodies smaller than :code:`threshold` bytes are sent uncompressed.
+
+    Bodies are decompressed as a stream and never beyond :code:`max_body_size` bytes, so that a small compressed
+    body can't exhaust the memory of a server.
+    """
+
+    threshold: int = 1024
+    """Minimum size in bytes of a compressed body"""
+
+    max_body_size: int = 64 * 1024 * 1024
+    """Maximum size in bytes of a body, after decompression"""
+
+    gzip_level: int = 6
+    zstd_level: int = 3
+
+    _server_encodings: dict[str, list[str]] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def supported_encodings() -> list[str]:
+        """Returns the encodings we can compress and decompress, in order of preference."""
+        return ['zstd', 'gzip'] if zstandard is not None else ['gzip']
+
+    @staticmethod
+    def response_encodings() -> list[str]:
+        """Returns the encodings the HTTP client can decode in responses, in order of preference."""
+        decoders = getattr(urllib3.response.HTTPResponse, 'CONTENT_DECODERS', ['gzip', 'deflate'])
+        return [e for e in HttpCompression.supported_encodings() if e in decoders]
+
+    @staticmethod
+    def accept_encoding_header(encodings: list[str]) -> str:
+        return ", ".join(encodings) or "identity"
+
+    @staticmethod
+    def choose(accept_encoding: Optional[str]) -> Optional[str]:
+        """Returns our preferred encoding among those in an Accept-Encoding header, None if there is none."""
+        if not accept_encoding:
+            return None
+        accepted = set()
+        for item in accept_encoding.split(","):
+            name, _, params = item.strip().partition(";")
+            if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                accepted.add(name.strip().lower())
+        return next((e for e in HttpCompression.supported_encodings() if e in accepted), None)
+
+    @staticmethod
+    def compress(body: bytes, encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+        """Compresses the body if it is large enough. Returns the body and the encoding used, if any."""
+        if encoding is None or len(body) < HttpCompression.threshold:
+            return body, None
+        if encoding == 'zstd':
+            return zstandard.ZstdCompressor(level=HttpCompression.zstd_level).compress(body), encoding
+        if encoding == 'gzip':
+            return gzip.compress(body, compresslevel=HttpCompression.gzip_level), encoding
+        raise ValueError(f"Unsupported encoding {encoding}")
+
+    @staticmethod
+    def decompress(body: bytes, encoding: Optional[str]) -> bytes:
+        """Decompresses a body.
+
+        Raises :code:`BodyTooLargeError` if the body is larger than :code:`max_body_size` bytes, and ValueError if
+        the encoding is unsupported or the data is corrupt.
+        """
+        encoding = (encoding or "identity").strip().lower()
+        limit = HttpCompression.max_body_size
+        try:
+            if encoding == 'identity':
+                decompressed = body
+            elif encoding == 'gzip':
+                with gzip.GzipFile(fileobj=io.BytesIO(body)) as reader:
+                    decompressed = reader.read(limit + 1)
+            elif encoding == 'zstd' and zstandard is not None:
+                with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as reader:
+                    decompressed = HttpCompression._read(reader, limit + 1)
+            else:
+                raise ValueError(f"Unsupported encoding {encoding}")
+        except (OSError, EOFError) as e:
+            raise ValueError(f"Corrupt {encoding} body") from e
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                raise ValueError(f"Corrupt {encoding} body") from e
+            raise
+        if len(decompressed) > limit:
+            raise BodyTooLargeError(f"Body larger than {limit} bytes")
+        return decompressed
+
+    @staticmethod
+    def _read(reader: io.RawIOBase, size: int) -> bytes:
+        """Reads up to size bytes, fewer only at the end of the stream."""
+        parts = []
+        while size > 0:
+            part = reader.read(min(size, 1 << 20))
+            if not part:
+                break
+            parts.append(part)
+            size -= len(part)
+        return b"".join(parts)
+
+    @staticmethod
+    def request_encoding(url: str) -> Optional[str]:
+        """Returns the encoding to compress requests to the URL with, None if the server accepts none."""
+        with HttpCompression._lock:
+            encodings = HttpCompression._server_encodings.get(url)
+        return HttpCompression.choose(", ".join(encodings)) if encodings else None
+
+    @staticmethod
+    def record_server_encodings(url: str, accept_encoding: Optional[str]):
+        """Remembers the encodings a server accepts, from the Accept-Encoding header of its response."""
+        encodings = [e.strip().lower() for e in accept_encoding.split(",")] if accept_encoding else []
+        with HttpCompression._lock:
+            HttpCompression._server_encodings[url] = encodings
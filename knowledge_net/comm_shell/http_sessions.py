@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+from knowledge_net.chat.chat_event import ChatEvent
+from knowledge_net.chat.chat_history import ChatHistory
+
+
+class SessionCache:
+    """All-static class keeping the chat histories of recent sessions on the server side.
+
+    In the session protocol, the caller sends a session id, the number of events the server already has
+    (:code:`base_length`) and only the events after those. The server rebuilds the full chat history from the
+    stored one. Histories are kept per session and knowledge base, in a least recently used cache of
+    :code:`max_sessions` entries. When the server doesn't have the expected history, the caller resends it in full.
+    """
+
+    max_sessions: int = 1000
+    """Maximum number of chat histories kept"""
+
+    _histories: "OrderedDict[tuple[str, str], ChatHistory]" = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def resume(kb_name: str, session: dict[str, Any], new_events: ChatHistory) -> Optional[ChatHistory]:
+        """Returns the stored history of the session extended with the new events, None if it isn't available.
+
+        The resulting history is stored for the next call. Raises ValueError if the session description is invalid.
+        """
+        if not isinstance(session, dict) or not isinstance(session.get('id'), str) \
+                or not isinstance(session.get('base_length'), int):
+            raise ValueError("Session requires 'id' and 'base_length'")
+        key = (session['id'], kb_name)
+        if session['base_length'] == 0:
+            chat_history = new_events
+        else:
+            with SessionCache._lock:
+                stored = SessionCache._histories.get(key)
+            if stored is None or len(stored) != session['base_length']:
+                return None
+            chat_history = stored.copy()
+            chat_history.extend(new_events)
+        chat_history.set_session_id(session['id'])
+        with SessionCache._lock:
+            SessionCache._histories[key] = chat_history.copy()
+            SessionCache._histories.move_to_end(key)
+            while len(SessionCache._histories) > SessionCache.max_sessions:
+                SessionCache._histories.popitem(last=False)
+        return chat_history
+
+    @staticmethod
+    def clear():
+        with SessionCache._lock:
+            SessionCache._histories.clear()
+
+
+class SessionTracker:
+    """All-static class remembering, on the caller side, how much of each session a remote knowledge base has.
+
+    For each URL, knowledge base and session, we keep the number of events sent and the last event sent. A chat
+    history that still has that event at that position continues what was sent, since histories only grow and
+    events are immutable, so only the events after it need to be sent.
+    """
+
+    max_sessions: int = 1000
+    """Maximum number of sessions tracked"""
+
+    _sent: "OrderedDict[tuple[str, str, str], tuple[int, ChatEvent]]" = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def known_length(url: str, kb_name: str, chat_history: ChatHistory) -> int:
+        """Returns the number of events of the chat history that the remote knowledge base already has."""
+        with SessionTracker._lock:
+            sent = SessionTracker._sent.get((url, kb_name, chat_history.get_session_id()))
+        if sent is None:
+            return 0
+        length, last_event = sent
+        return length if chat_history.event_at(length - 1) is last_event else 0
+
+    @staticmethod
+    def record_sent(url: str, kb_name: str, chat_history: ChatHistory):
+        """Records that the remote knowledge base has received the chat history."""
+        if chat_history.is_empty():
+            return
+        key = (url, kb_name, chat_history.get_session_id())
+        with SessionTracker._lock:
+            SessionTracker._sent[key] = (len(chat_history), chat_history.get_last_event())
+            SessionTracker._sent.move_to_end(key)
+            while len(SessionTracker._sent) > SessionTracker.max_sessions:
+                SessionTracker._sent.popitem(last=False)
+
+    @staticmethod
+    def forget(url: str, kb_name: str, chat_history: ChatHistory):
+        """Forgets what was sent, so that the chat history is sent in full next time."""
+        with SessionTracker._lock:
+            SessionTracker._sent.pop((url, kb_name, chat_history.get_session_id()), None)
@@ -0,0 +1,94 @@
+import hashlib
+import re
+from typing import Tuple, Optional
+
+from knowledge_net.chat.chat_event import EventType, SummaryType
+from knowledge_net.chat.chat_history import ChatHistory
+from knowledge_net.experimental.caching.reply_cache import ReplyCache
+from knowledge_net.knowledgebase.knowledgebase import Knowledgebase
+
+
+class CachedKnowledgebase(Knowledgebase):
+    """Knowledgebase answering from a cache of the replies of another knowledgebase.
+
+    The cached knowledgebase is given as :code:`knowledgebase`, or is the single connected knowledgebase when
+    instantiated from a json configuration. Replies are keyed on the identifier of the cached knowledgebase and the
+    normalized standalone question, if the chat history ends with one, otherwise the normalized message history.
+    Replies with errors are not cached. Cached replies come back without calling the knowledgebase, as the reply
+    of this knowledgebase with the usual call and return events.
+
+    The cache is in memory by default. With :code:`backend="sqlite"`, it is kept in the file
+    :code:`database_file`, see :code:`ReplyCache`.
+    """
+
+    def __init__(self,
+                 identifier: str,
+                 display_name: Optional[str] = None,
+                 description: str = None,
+                 knowledgebase: Optional[Knowledgebase] = None,
+                 cache: Optional[ReplyCache] = None,
+                 backend: str = 'memory',
+                 database_file: Optional[str] = None,
+                 ttl_seconds: Optional[float] = ReplyCache.DEFAULT_TTL,
+                 max_entries: int = ReplyCache.DEFAULT_MAX_ENTRIES):
+        super().__init__(identifier, display_name, description)
+        self.knowledgebase = knowledgebase
+        self.cache = cache or ReplyCache.create(backend, path=database_file, ttl_seconds=ttl_seconds,
+                                                max_entries=max_entries)
+
+    def _reply(self, chat_history: ChatHistory) -> Tuple[ChatHistory, Optional[str]]:
+        knowledgebase = self.cached_knowledgebase()
+        key = self.cache_key(knowledgebase, chat_history)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return ChatHistory.from_json(cached), None
+        return self._store(key, knowledgebase.reply(chat_history, caller=self.identifier))
+
+    async def _areply(self, chat_history: ChatHistory) -> Tuple[ChatHistory, Optional[str]]:
+        knowledgebase = self.cached_knowledgebase()
+        key = self.cache_key(knowledgebase, chat_history)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return ChatHistory.from_json(cached), None
+        return self._store(key, await knowledgebase.areply(chat_history, caller=self.identifier))
+
+    def _store(self, key: str, response: ChatHistory) -> Tuple[ChatHistory, Optional[str]]:
+        """Caches the reply unless it has an error. Returns the reply without the call and return events."""
+        error = response.get_error()[1] if response.returned_error() else None
+        continuation = ChatHistory([e for e in response.events()
+                                    if e.event_type not in (EventType.call, EventType.ret)])
+        if not error:
+            self.cache.put(key, continuation.as_json_bytes())
+        return continuation, error
+
+    def cached_knowledgebase(self) -> Knowledgebase:
+        """Returns the knowledgebase whose replies are cached."""
+        if self.knowledgebase is not None:
+            return self.knowledgebase
+        if len(self._connected_knowledgebases) != 1:
+            raise ValueError(f"{self.identifier} needs a knowledgebase or exactly one connected knowledgebase")
+        return next(iter(self._connected_knowledgebases.values()))
+
+    @staticmethod
+    def cache_key(knowledgebase: Knowledgebase, chat_history: ChatHistory) -> str:
+        """Returns the key of the reply of the knowledgebase to the chat history."""
+        text = knowledgebase.identifier + "\n" + CachedKnowledgebase.cache_question(chat_history)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def cache_question(chat_history: ChatHistory) -> str:
+        """Returns the normalized standalone question ending the chat history, or else the message history."""
+        for i in range(len(chat_history) - 1, -1, -1):
+            event = chat_history.event_at(i)
+            if event.event_type == EventType.call:
+                continue
+            if event.event_type == EventType.summary and event.summary_type == SummaryType.standalone_question:
+                return CachedKnowledgebase.normalize(event.summary_text)
+            break
+        return "\n".join(f"{m.role.value}: {CachedKnowledgebase.normalize(m.message_text)}"
+                         for m in chat_history.get_messages())
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Ignores case, extra whitespace and trailing punctuation."""
+        return re.sub(r"\s+", " ", text.casefold()).strip(" ?!.")
@@ -0,0 +1,151 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+
+class ReplyCache:
+    """Base class of the caches storing replies under string keys.
+
+    Entries expire :code:`ttl_seconds` after they were stored, never if it is None. When there are more than
+    :code:`max_entries` entries, the least recently used are evicted. Subclasses implement the storage, see
+    :code:`MemoryReplyCache` and :code:`SQLiteReplyCache`. Hits and misses are counted.
+    """
+
+    DEFAULT_TTL = 24 * 60 * 60
+    """Default time to live of an entry in seconds"""
+
+    DEFAULT_MAX_ENTRIES = 10000
+
+    def __init__(self, ttl_seconds: Optional[float] = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create(backend: str = 'memory', path: Optional[Union[str, Path]] = None,
+               ttl_seconds: Optional[float] = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES) -> "ReplyCache":
+        """Creates a cache with the named backend, 'memory' or 'sqlite'. The SQLite backend requires a file path."""
+        if backend == 'memory':
+            return MemoryReplyCache(ttl_seconds=ttl_seconds, max_entries=max_entries)
+        if backend == 'sqlite':
+            if path is None:
+                raise ValueError("The sqlite reply cache requires a path")
+            return SQLiteReplyCache(path, ttl_seconds=ttl_seconds, max_entries=max_entries)
+        raise ValueError(f"Unknown reply cache backend {backend}")
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Returns the value stored under the key, or None if there is none or it has expired."""
+        with self._lock:
+            value = self._get(key, time.time())
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key: str, value: bytes):
+        """Stores the value under the key, evicting the least recently used entries if the cache is full."""
+        expires = time.time() + self.ttl_seconds if self.ttl_seconds is not None else None
+        with self._lock:
+            self._put(key, value, expires)
+
+    def clear(self):
+        """Removes all entries and resets the counters."""
+        with self._lock:
+            self._clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        """Returns the number of hits, misses and entries."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': self._size()}
+
+    def _get(self, key: str, now: float) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def _put(self, key: str, value: bytes, expires: Optional[float]):
+        raise NotImplementedError
+
+    def _clear(self):
+        raise NotImplementedError
+
+    def _size(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryReplyCache(ReplyCache):
+    """Reply cache in the memory of the process."""
+
+    def __init__(self, ttl_seconds: Optional[float] = ReplyCache.DEFAULT_TTL,
+                 max_entries: int = ReplyCache.DEFAULT_MAX_ENTRIES):
+        super().__init__(ttl_seconds=ttl_seconds, max_entries=max_entries)
+        self._entries: OrderedDict[str, Tuple[bytes, Optional[float]]] = OrderedDict()
+
+    def _get(self, key: str, now: float) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put(self, key: str, value: bytes, expires: Optional[float]):
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _clear(self):
+        self._entries.clear()
+
+    def _size(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteReplyCache(ReplyCache):
+    """Reply cache in an SQLite database file, shared between processes and kept across restarts."""
+
+    def __init__(self, path: Union[str, Path], ttl_seconds: Optional[float] = ReplyCache.DEFAULT_TTL,
+                 max_entries: int = ReplyCache.DEFAULT_MAX_ENTRIES):
+        super().__init__(ttl_seconds=ttl_seconds, max_entries=max_entries)
+        self.path = Path(path)
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS replies "
+                                 "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL, last_used REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS replies_last_used ON replies (last_used)")
+
+    def _get(self, key: str, now: float) -> Optional[bytes]:
+        row = self._connection.execute("SELECT value, expires FROM replies WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires <= now:
+            self._connection.execute("DELETE FROM replies WHERE key = ?", (key,))
+            return None
+        self._connection.execute("UPDATE replies SET last_used = ? WHERE key = ?", (now, key))
+        return value
+
+    def _put(self, key: str, value: bytes, expires: Optional[float]):
+        self._connection.execute("INSERT OR REPLACE INTO replies (key, value, expires, last_used) "
+                                 "VALUES (?, ?, ?, ?)", (key, value, expires, time.time()))
+        self._connection.execute("DELETE FROM replies WHERE key IN (SELECT key FROM replies "
+                                 "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def _clear(self):
+        self._connection.execute("DELETE FROM replies")
+
+    def _size(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM replies").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
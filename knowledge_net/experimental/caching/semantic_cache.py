@@ -0,0 +1,107 @@
+import threading
+from typing import Optional
+
+import numpy as np
+
+
+class SemanticCache:
+    """Cache of answers looked up by the similarity of question embeddings.
+
+    An answer is returned for a question whose embedding has a cosine similarity of at least :code:`threshold` with
+    the embedding of a previously answered question. The embeddings are kept as the rows of a normalized matrix, so
+    a lookup is one matrix-vector product. When the cache holds :code:`max_entries` answers, the oldest are replaced.
+    Embeddings of another dimension than the cached ones, e.g. after switching embedding provider, never match, and
+    adding one empties the cache.
+
+    Answers are only valid for a given version of the data they came from, like the build stamp of a database.
+    Call :code:`validate` with the current version before looking up; the cache is emptied when the version changes.
+    """
+
+    DEFAULT_THRESHOLD = 0.95
+    """Default minimum cosine similarity between questions sharing an answer"""
+
+    DEFAULT_MAX_ENTRIES = 10000
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, max_entries: int = DEFAULT_MAX_ENTRIES):
+        if max_entries < 1:
+            raise ValueError(f"The semantic cache needs room for at least one entry, got max_entries={max_entries}")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.version: Optional[str] = None
+        self._embeddings: Optional[np.ndarray] = None
+        self._questions: list[str] = []
+        self._answers: list[str] = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def validate(self, version: Optional[str]):
+        """Empties the cache if the answers were given for another version of the data."""
+        with self._lock:
+            if version != self.version:
+                self._clear()
+                self.version = version
+
+    def lookup(self, embedding: list[float]) -> Optional[str]:
+        """Returns the answer to the most similar previous question if it is similar enough, otherwise None."""
+        query = SemanticCache._normalized(embedding)
+        with self._lock:
+            answer = None
+            if self._answers and self._embeddings.shape[1] == len(query):
+                similarities = self._embeddings[:len(self._answers)] @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    answer = self._answers[best]
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return answer
+
+    def add(self, embedding: list[float], question: str, answer: str):
+        """Stores the answer to the question with the given embedding."""
+        row = SemanticCache._normalized(embedding)
+        with self._lock:
+            if self._embeddings is None or self._embeddings.shape[1] != len(row):
+                self._clear()
+                self._embeddings = np.zeros((min(self.max_entries, 64), len(row)), dtype=np.float32)
+            n = len(self._answers)
+            if n < self.max_entries:
+                if n == len(self._embeddings):
+                    grown = np.zeros((min(self.max_entries, 2 * n), len(row)), dtype=np.float32)
+                    grown[:n] = self._embeddings
+                    self._embeddings = grown
+                self._embeddings[n] = row
+                self._questions.append(question)
+                self._answers.append(answer)
+            else:
+                i = self._next
+                self._embeddings[i] = row
+                self._questions[i] = question
+                self._answers[i] = answer
+                self._next = (i + 1) % self.max_entries
+
+    def clear(self):
+        """Removes all answers and resets the counters."""
+        with self._lock:
+            self._clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        """Returns the number of hits, misses and entries."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._answers)}
+
+    def _clear(self):
+        self._embeddings = None
+        self._questions = []
+        self._answers = []
+        self._next = 0
+
+    @staticmethod
+    def _normalized(embedding: list[float]) -> np.ndarray:
+        v = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm > 0 else v
@@ -1,10 +1,19 @@
+import hashlib
+import json
+import math
 import os.path
 import shutil
+import time
+import uuid
 from pathlib import Path
+from typing import Optional, Iterable, Iterator, Tuple, Any
 
+import chromadb
 from langchain.schema import Document
 from langchain_community.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
+from langchain_core.embeddings import Embeddings
+from knowledge_net.experimental.database.embedding_cache import CachedEmbeddings
+from knowledge_net.experimental.database.embeddings import EmbeddingProviders
 from knowledge_net.experimental.database.document_pipeline import DocumentPipeline
 from knowledge_net.experimental.database.document_processor import DocumentProcessor
 
@@ -12,37 +21,187 @@ from knowledge_net.experimental.database.document_processor import DocumentProce
 class Database:
     """Creates and loads the vector database."""
 
-    def __init__(self, directory: Path, openai_api_key: str):
+    BUILD_STAMP_FILE = "build_stamp"
+    """File in the database directory identifying the build"""
+
+    MANIFEST_FILE = "manifest.json"
+    """File in the database directory listing the source files of an incremental build"""
+
+    COLLECTION_NAME = "langchain"
+    """Name of the Chroma collection holding the chunks, the default of langchain"""
+
+    EMBEDDING_CACHE_SUFFIX = "_embedding_cache"
+
+    BUILD_STAMP_CHECK_INTERVAL = 5.0
+    """Seconds during which :code:`current_build_stamp` returns the stamp it last read"""
+
+    DEFAULT_EMBED_BATCH_SIZE = 256
+    """Default number of chunks embedded per call"""
+
+    DEFAULT_INSERT_BATCH_SIZE = 1024
+    """Default number of chunks inserted into the database at a time"""
+
+    def __init__(self, directory: Path, openai_api_key: Optional[str], embedding_cache_directory: Optional[Path] = None,
+                 embeddings: Optional[dict[str, Any]] = None):
+        """Creates the database object.
+
+        Chunks and queries are embedded with the provider configured in :code:`embeddings`, by default OpenAI, see
+        :code:`EmbeddingProviders`. Embeddings are cached in :code:`embedding_cache_directory`, by default a
+        directory next to the database named after it, so that rebuilding the database only embeds new chunks.
+        """
         self.directory = directory
         self.openai_api_key = openai_api_key
+        self.embeddings = embeddings
+        self.embedding_cache_directory = embedding_cache_directory or \
+            Path(str(directory) + Database.EMBEDDING_CACHE_SUFFIX)
+        self._build_stamp: Optional[str] = None
+        self._build_stamp_read = -math.inf
+
+    def build_from_folder(self, document_directory: Path, processor: DocumentProcessor, workers: int = 1) -> Chroma:
+        """Convenience function that builds a database from all the files in a folder and sub folders.
+
+        The files are split on :code:`workers` processes and the chunks are streamed into the database, see
+        :code:`DocumentPipeline.iter_prepared` and :code:`build`.
+        """
+        pipeline = DocumentPipeline()
+        pipeline.add_recursively(document_directory, processor)
+        return self.build(pipeline.iter_prepared(workers=workers))
 
-    def build_from_folder(self, document_directory: Path, processor: DocumentProcessor) -> Chroma:
-        """Convenience function that builds a database from all the files in a folder and sub folders."""
+    def build_incrementally_from_folder(self, document_directory: Path, processor: DocumentProcessor) -> Chroma:
+        """Updates the database with the changes to the files in a folder and sub folders since the last build.
+
+        Only new and changed files are split and embedded, and the chunks of changed and removed files are deleted.
+        A manifest in the database directory records the modification time, content hash and chunk ids of each
+        file; files whose modification time changed but not their content are left alone. A database without a
+        manifest is rebuilt from scratch.
+        """
         pipeline = DocumentPipeline()
         pipeline.add_recursively(document_directory, processor)
-        docs = pipeline.prepare_all()
-        return self.build(docs)
 
-    def build(self, docs: list[Document]) -> Chroma:
+        manifest_file = Path(self.directory) / Database.MANIFEST_FILE
+        if manifest_file.exists():
+            manifest = json.loads(manifest_file.read_text())
+        else:
+            if os.path.exists(self.directory):
+                shutil.rmtree(self.directory)
+            manifest = {}
+        database = self.load()
+
+        changed = False
+        files = {}
+        for file, file_processor in pipeline.files:
+            key = str(file)
+            entry = manifest.get(key)
+            mtime = os.path.getmtime(file)
+            if entry is not None and entry['mtime'] == mtime:
+                files[key] = entry
+                continue
+            content_hash = Database.file_hash(file)
+            if entry is not None and entry['sha256'] == content_hash:
+                files[key] = dict(entry, mtime=mtime)
+                continue
+            if entry is not None and entry['ids']:
+                database.delete(ids=entry['ids'])
+            docs = pipeline.prepare_one(file, file_processor)
+            ids = [hashlib.sha256(f"{key}\0{content_hash}\0{i}".encode('utf-8')).hexdigest()
+                   for i in range(len(docs))]
+            if docs:
+                database.add_documents(docs, ids=ids)
+            files[key] = {'mtime': mtime, 'sha256': content_hash, 'ids': ids}
+            changed = True
+
+        removed_ids = [i for key, entry in manifest.items() if key not in files for i in entry['ids']]
+        if removed_ids:
+            database.delete(ids=removed_ids)
+        changed = changed or len(files) != len(manifest)
+
+        database.persist()
+        os.makedirs(self.directory, exist_ok=True)
+        manifest_file.write_text(json.dumps(files, indent=1))
+        if changed or not (Path(self.directory) / Database.BUILD_STAMP_FILE).exists():
+            self._write_build_stamp()
+        return database
+
+    @staticmethod
+    def file_hash(file: Path) -> str:
+        """Returns the SHA-256 hash of the contents of the file."""
+        h = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def build(self, docs: Iterable[Document], embed_batch_size: int = DEFAULT_EMBED_BATCH_SIZE,
+              insert_batch_size: int = DEFAULT_INSERT_BATCH_SIZE) -> Chroma:
         """Builds a Chroma database from the documents.
 
         If the database directory exists, it will be deleted before creating the new database.
+
+        The documents can come from a generator. They are embedded :code:`embed_batch_size` at a time and inserted
+        :code:`insert_batch_size` at a time, pulling documents only as fast as they are stored, so memory use
+        doesn't grow with the number of documents. The embeddings are inserted through the collection of a Chroma
+        client, since the langchain vector store can only insert texts it embeds itself.
         """
 
         if os.path.exists(self.directory):
             shutil.rmtree(self.directory)
-        database = Chroma.from_documents(
-            documents=docs,
-            embedding=self.get_embeddings(),
-            persist_directory=str(self.directory)
-        )
+        client = chromadb.PersistentClient(path=str(self.directory))
+        database = self.load(client=client)
+        collection = client.get_or_create_collection(Database.COLLECTION_NAME)
+        embedded = Database.embed(docs, self.get_embeddings(), embed_batch_size)
+        for batch in DocumentPipeline.batched(embedded, insert_batch_size):
+            collection.upsert(ids=[str(uuid.uuid4()) for _ in batch],
+                              embeddings=[vector for _, vector in batch],
+                              metadatas=[doc.metadata for doc, _ in batch],
+                              documents=[doc.page_content for doc, _ in batch])
         database.persist()
+        os.makedirs(self.directory, exist_ok=True)
+        self._write_build_stamp()
         return database
 
-    def load(self) -> Chroma:
-        """Loads the database from the persistent directory."""
-        return Chroma(embedding_function=self.get_embeddings(), persist_directory=str(self.directory))
+    @staticmethod
+    def embed(docs: Iterable[Document], embeddings: Embeddings, batch_size: int) \
+            -> Iterator[Tuple[Document, list[float]]]:
+        """Yields the documents with their embeddings, embedding :code:`batch_size` documents per call."""
+        for batch in DocumentPipeline.batched(docs, batch_size):
+            yield from zip(batch, embeddings.embed_documents([doc.page_content for doc in batch]))
+
+    def build_stamp(self) -> Optional[str]:
+        """Returns an identifier that changes whenever the database is rebuilt, None if there is no database.
+
+        Databases built before build stamps were introduced are identified by the modification time of the
+        directory.
+        """
+        stamp_file = Path(self.directory) / Database.BUILD_STAMP_FILE
+        try:
+            return stamp_file.read_text()
+        except FileNotFoundError:
+            return str(os.path.getmtime(self.directory)) if os.path.exists(self.directory) else None
+
+    def current_build_stamp(self) -> Optional[str]:
+        """Returns the build stamp, reading it again only every :code:`BUILD_STAMP_CHECK_INTERVAL` seconds.
+
+        For checks on every request. Builds made with this object are seen at once, builds made by other processes
+        within the interval.
+        """
+        now = time.monotonic()
+        if now - self._build_stamp_read >= Database.BUILD_STAMP_CHECK_INTERVAL:
+            self._build_stamp = self.build_stamp()
+            self._build_stamp_read = now
+        return self._build_stamp
+
+    def _write_build_stamp(self):
+        stamp = uuid.uuid4().hex
+        (Path(self.directory) / Database.BUILD_STAMP_FILE).write_text(stamp)
+        self._build_stamp = stamp
+        self._build_stamp_read = time.monotonic()
+
+    def load(self, client: Optional[chromadb.ClientAPI] = None) -> Chroma:
+        """Loads the database from the persistent directory, through the Chroma client if given."""
+        return Chroma(collection_name=Database.COLLECTION_NAME, embedding_function=self.get_embeddings(),
+                      persist_directory=str(self.directory), client=client)
 
-    def get_embeddings(self) -> OpenAIEmbeddings:
-        """Returns the embeddings to use."""
-        return OpenAIEmbeddings(openai_api_key=self.openai_api_key)
+    def get_embeddings(self) -> Embeddings:
+        """Returns the embeddings to use, cached in the embedding cache directory."""
+        return CachedEmbeddings.shared(EmbeddingProviders.create(self.embeddings, openai_api_key=self.openai_api_key),
+                                       directory=self.embedding_cache_directory)
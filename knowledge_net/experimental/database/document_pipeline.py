@@ -1,6 +1,10 @@
 import os
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from itertools import islice
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Callable, Tuple, Any, Iterable, Iterator
 
 from langchain.schema import Document
 from knowledge_net.experimental.database.document_processor import DocumentProcessor, TextDocumentProcessor
@@ -14,6 +18,8 @@ class DocumentPipeline:
         self.default_processors: dict[str, DocumentProcessor] = {
             "txt": TextDocumentProcessor()
         }
+        self.errors: list[tuple[Path, str]] = []
+        """Files that couldn't be processed in the last run, with the error"""
 
     def add_file(self, file: Path, document_processor: Optional[DocumentProcessor] = None):
         """Adds a single file to the files to process."""
@@ -32,9 +38,83 @@ class DocumentPipeline:
                 else:
                     self.add_file(path, document_processor)
 
-    def prepare_all(self) -> list[Document]:
-        """Turns all the files into embeddable chunks."""
-        return [d for docs in [self.prepare_one(f, p) for (f, p) in self.files] for d in docs]
+    def prepare_all(self, workers: int = 1, chunksize: int = 1) -> list[Document]:
+        """Turns all the files into embeddable chunks.
+
+        With more than one worker, files are processed in parallel on a pool of :code:`workers` processes, which
+        are handed :code:`chunksize` files at a time. The chunks come in the order of the files either way. Files
+        that can't be processed are skipped with a warning and listed in :code:`errors`.
+        """
+        return list(self.iter_prepared(workers=workers, chunksize=chunksize))
+
+    def iter_prepared(self, workers: int = 1, chunksize: int = 1, window: Optional[int] = None) -> Iterator[Document]:
+        """Turns the files into embeddable chunks, yielding them as the files are processed.
+
+        Like :code:`prepare_all`, but only :code:`window` groups of :code:`chunksize` files, by default two per
+        worker, are processed ahead of the consumer. Memory use therefore doesn't grow with the number of files.
+        """
+        jobs = ((f, p, self.default_processors) for (f, p) in self.files)
+        for docs in self._imap(DocumentPipeline._prepare_job, jobs, workers, chunksize, window):
+            yield from docs
+
+    def _imap(self, function: Callable[[tuple], Tuple[Any, Optional[str]]], jobs: Iterable[tuple], workers: int,
+              chunksize: int, window: Optional[int] = None) -> Iterator[Any]:
+        """Applies the function to the jobs, in worker processes if there is more than one worker.
+
+        Results are yielded in the order of the jobs. At most :code:`window` groups of :code:`chunksize` jobs are
+        submitted ahead of the one being yielded. The function returns a result and an error message. Jobs with
+        errors are reported and left out.
+        """
+        self.errors = []
+        if workers <= 1:
+            for job in jobs:
+                yield from self._report(job, function(job))
+            return
+
+        window = window or 2 * workers
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for group in DocumentPipeline.batched(jobs, chunksize):
+                pending.append((group, executor.submit(DocumentPipeline._run_group, function, group)))
+                while len(pending) >= window:
+                    yield from self._report_group(*pending.popleft())
+            while pending:
+                yield from self._report_group(*pending.popleft())
+
+    def _report_group(self, group: list[tuple], future: Future) -> Iterator[Any]:
+        for job, outcome in zip(group, future.result()):
+            yield from self._report(job, outcome)
+
+    def _report(self, job: tuple, outcome: Tuple[Any, Optional[str]]) -> Iterator[Any]:
+        """Yields the result of the job, or reports its error."""
+        result, error = outcome
+        if error is None:
+            yield result
+        else:
+            self.errors.append((job[0], error))
+            warnings.warn(f"Could not process {job[0]}: {error}")
+
+    @staticmethod
+    def _run_group(function: Callable[[tuple], Tuple[Any, Optional[str]]], group: list[tuple]) \
+            -> list[Tuple[Any, Optional[str]]]:
+        return [function(job) for job in group]
+
+    @staticmethod
+    def batched(items: Iterable[Any], size: int) -> Iterator[list[Any]]:
+        """Groups the items into lists of :code:`size` items, the last one possibly shorter."""
+        iterator = iter(items)
+        while batch := list(islice(iterator, size)):
+            yield batch
+
+    @staticmethod
+    def _prepare_job(job: Tuple[Path, Optional[DocumentProcessor], dict[str, DocumentProcessor]]) \
+            -> Tuple[list[Document], Optional[str]]:
+        file, processor, default_processors = job
+        try:
+            processor = processor or DocumentPipeline._default_processor(file, default_processors)
+            return processor(file), None
+        except Exception as e:
+            return [], f"{type(e).__name__}: {e}"
 
     def prepare_one(self, file: Path, processor: DocumentProcessor) -> list[Document]:
         """Turns a single file into embeddable chunks."""
@@ -48,8 +128,11 @@ class DocumentPipeline:
 
     def write_one_to_file(self, file: Path, processor: DocumentProcessor, source_root: Path, destination_root: Path):
         """Processes a single file without chunking, writes it to an output file."""
+        DocumentPipeline._write_output(file, processor or self.get_default_processor(file), source_root,
+                                       destination_root)
 
-        processor = processor or self.get_default_processor(file)
+    @staticmethod
+    def _write_output(file: Path, processor: DocumentProcessor, source_root: Path, destination_root: Path):
         output_text = processor.prepare_for_file(file)
         assert str(source_root) in str(file), f"File path {file} does not contain source root {source_root}"
         destination_path = Path(str(file).replace(str(source_root), str(destination_root), 1))
@@ -57,24 +140,41 @@ class DocumentPipeline:
         with open(destination_path, "w") as f:
             f.write(output_text)
 
-    def write_all_to_files(self, source_root: Path, destination_root: Path):
+    def write_all_to_files(self, source_root: Path, destination_root: Path, workers: int = 1, chunksize: int = 1):
         """Pre-processes all files without chunking them, writes the results to files.
 
-        Useful for producing documents that can be input to other retrieval systems.
+        Useful for producing documents that can be input to other retrieval systems. Files are processed in
+        parallel and errors are reported like in :code:`prepare_all`.
         """
-        for (f, p) in self.files:
-            self.write_one_to_file(file=f, processor=p, source_root=source_root, destination_root=destination_root)
+        jobs = ((f, p, self.default_processors, source_root, destination_root) for (f, p) in self.files)
+        for _ in self._imap(DocumentPipeline._write_job, jobs, workers, chunksize):
+            pass
+
+    @staticmethod
+    def _write_job(job: Tuple[Path, Optional[DocumentProcessor], dict[str, DocumentProcessor], Path, Path]) \
+            -> Tuple[None, Optional[str]]:
+        file, processor, default_processors, source_root, destination_root = job
+        try:
+            processor = processor or DocumentPipeline._default_processor(file, default_processors)
+            DocumentPipeline._write_output(file, processor, source_root, destination_root)
+            return None, None
+        except Exception as e:
+            return None, f"{type(e).__name__}: {e}"
 
     @staticmethod
-    def convert_folder(input_directory: Path, output_directory: Path, processor: DocumentProcessor):
+    def convert_folder(input_directory: Path, output_directory: Path, processor: DocumentProcessor, workers: int = 1):
         """Processes all files under the input_directory and writes the results to the output_directory."""
         pipe = DocumentPipeline()
         pipe.add_recursively(input_directory, processor)
-        pipe.write_all_to_files(source_root=input_directory, destination_root=output_directory)
+        pipe.write_all_to_files(source_root=input_directory, destination_root=output_directory, workers=workers)
 
     def get_default_processor(self, file: Path) -> DocumentProcessor:
         """Returns the default document processor for the file, based on its type."""
+        return DocumentPipeline._default_processor(file, self.default_processors)
+
+    @staticmethod
+    def _default_processor(file: Path, default_processors: dict[str, DocumentProcessor]) -> DocumentProcessor:
         suffix = file.suffix
         if suffix == ".crdownload":
             suffix = Path(file.stem).suffix
-        return self.default_processors[suffix[1:]]
+        return default_processors[suffix[1:]]
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from knowledge_net.experimental.database.embeddings import EmbeddingProviders
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings remembering the vectors of the texts they have embedded.
+
+    Wraps any embedding model. Vectors are keyed on a hash of the model namespace and the text, so unchanged texts
+    are never embedded twice, and models can share a cache directory without mixing up their vectors.
+
+    Document vectors live in memory without a directory. With a directory, they are kept in an SQLite database in
+    it, so the cache survives restarts and database rebuilds and can be shared by processes, like a server and a
+    database build. Query vectors are only kept in memory, the :code:`max_queries` most recently used, since
+    queries rarely repeat across restarts and some models embed them differently from documents.
+
+    Use :code:`shared` to get the cache for a model and directory, so that database builds, retrievers and routers
+    in the same process share it.
+    """
+
+    DATABASE_FILE = "embeddings.sqlite"
+
+    DEFAULT_MAX_QUERIES = 10000
+    """Default number of query vectors kept in memory"""
+
+    _shared: dict[tuple[str, Optional[str]], "CachedEmbeddings"] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, embeddings: Embeddings, directory: Optional[Path] = None, namespace: Optional[str] = None,
+                 max_queries: int = DEFAULT_MAX_QUERIES):
+        self.embeddings = embeddings
+        self.directory = Path(directory) if directory is not None else None
+        self.namespace = namespace or CachedEmbeddings.default_namespace(embeddings)
+        self.max_queries = max_queries
+        self.hits = 0
+        self.misses = 0
+        self._documents: dict[str, np.ndarray] = {}
+        self._queries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        if self.directory is not None:
+            self._open()
+
+    @staticmethod
+    def shared(embeddings: Embeddings, directory: Optional[Path] = None,
+               namespace: Optional[str] = None) -> "CachedEmbeddings":
+        """Returns the cache of the process for the model namespace and directory, creating it on first use."""
+        namespace = namespace or CachedEmbeddings.default_namespace(embeddings)
+        key = (namespace, str(Path(directory).resolve()) if directory is not None else None)
+        with CachedEmbeddings._shared_lock:
+            cache = CachedEmbeddings._shared.get(key)
+            if cache is None:
+                cache = CachedEmbeddings(embeddings, directory=directory, namespace=namespace)
+                CachedEmbeddings._shared[key] = cache
+        return cache
+
+    @staticmethod
+    def default_namespace(embeddings: Embeddings) -> str:
+        """Names the model, so that vectors of different models are kept apart."""
+        model = getattr(embeddings, 'model', None) or getattr(embeddings, 'model_name', None)
+        return f"{type(embeddings).__name__}:{model}" if model else type(embeddings).__name__
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embeds the texts, calling the model once for all the texts not in the cache."""
+        keys = [self._key(t) for t in texts]
+        with self._lock:
+            found = self._get_documents(set(keys))
+        missing = {k: t for k, t in zip(keys, texts) if k not in found}
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            vectors = np.asarray(self.embeddings.embed_documents(list(missing.values())), dtype=np.float32)
+            new = dict(zip(missing.keys(), vectors))
+            with self._lock:
+                self._put_documents(new)
+            found.update(new)
+        return [found[k].tolist() for k in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_queries([text])[0]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """Embeds the text as a query with the asynchronous API of the model, unless it is in the cache."""
+        key = self._key(text)
+        vector = self._get_queries([key]).get(key)
+        if vector is None:
+            vector = np.asarray(await self.embeddings.aembed_query(text), dtype=np.float32)
+            self._put_queries({key: vector})
+        return vector.tolist()
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """Embeds the texts as queries, calling the model once for all the texts not in the cache if it can."""
+        keys = [self._key(t) for t in texts]
+        found = self._get_queries(keys)
+        missing = {k: t for k, t in zip(keys, texts) if k not in found}
+        if missing:
+            vectors = EmbeddingProviders.embed_queries(self.embeddings, list(missing.values()))
+            new = {k: np.asarray(v, dtype=np.float32) for k, v in zip(missing.keys(), vectors)}
+            self._put_queries(new)
+            found.update(new)
+        return [found[k].tolist() for k in keys]
+
+    def stats(self) -> dict[str, int]:
+        """Returns the number of hits, misses and cached document and query vectors."""
+        with self._lock:
+            if self._connection is None:
+                documents = len(self._documents)
+            else:
+                documents = self._connection.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'entries': documents, 'queries': len(self._queries)}
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.namespace}\0{text}".encode('utf-8')).hexdigest()
+
+    def _get_queries(self, keys: list[str]) -> dict[str, np.ndarray]:
+        """Returns the cached query vectors of those keys that are in the cache, counting hits and misses."""
+        found = {}
+        with self._lock:
+            for k in keys:
+                vector = self._queries.get(k)
+                if vector is not None:
+                    self._queries.move_to_end(k)
+                    found[k] = vector
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return found
+
+    def _put_queries(self, vectors: dict[str, np.ndarray]):
+        with self._lock:
+            self._queries.update(vectors)
+            while len(self._queries) > self.max_queries:
+                self._queries.popitem(last=False)
+
+    def _get_documents(self, keys: set[str]) -> dict[str, np.ndarray]:
+        """Returns the cached vectors of those keys that are in the cache."""
+        if self._connection is None:
+            return {k: self._documents[k] for k in keys if k in self._documents}
+        found = {}
+        keys = list(keys)
+        # Stay below the limit of SQLite on the number of parameters of a statement
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            rows = self._connection.execute(
+                f"SELECT key, vector FROM vectors WHERE key IN ({','.join('?' * len(part))})", part).fetchall()
+            found.update((k, np.frombuffer(v, dtype=np.float32)) for k, v in rows)
+        return found
+
+    def _put_documents(self, vectors: dict[str, np.ndarray]):
+        if self._connection is None:
+            self._documents.update(vectors)
+            return
+        self._connection.executemany("INSERT OR IGNORE INTO vectors (key, vector) VALUES (?, ?)",
+                                     [(k, v.tobytes()) for k, v in vectors.items()])
+
+    def _open(self):
+        """Opens the database of the cache directory, creating it if needed."""
+        os.makedirs(self.directory, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.directory / CachedEmbeddings.DATABASE_FILE),
+                                           check_same_thread=False, isolation_level=None, timeout=60)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
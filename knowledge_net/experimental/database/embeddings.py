@@ -0,0 +1,179 @@
+import re
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Any, Callable
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+try:
+    import sentence_transformers
+except ImportError:
+    sentence_transformers = None
+
+
+class EmbeddingProviders:
+    """Creates the embedding model selected by a configuration.
+
+    A configuration is a dictionary naming the :code:`provider`, with the other entries passed to the model, e.g.
+    :code:`{"provider": "sentence-transformers", "model_name": "all-MiniLM-L6-v2", "threads": 4}`. The providers are
+
+    - :code:`openai`, the default, calling the OpenAI API, see :code:`OpenAIEmbeddings`
+    - :code:`sentence-transformers`, running a local model on the CPU, see :code:`SentenceTransformerEmbeddings`
+    - :code:`hashing`, hashing words and word pairs without any model, see :code:`HashingEmbeddings`
+
+    More providers can be added with :code:`register`. The vectors of different providers are not comparable, so a
+    database must be queried with the provider it was built with.
+    """
+
+    DEFAULT_PROVIDER = "openai"
+
+    _providers: dict[str, Callable[..., Embeddings]] = {}
+
+    @staticmethod
+    def register(name: str, factory: Callable[..., Embeddings]):
+        """Makes the provider available under the name. The factory is called with the configuration entries."""
+        EmbeddingProviders._providers[name] = factory
+
+    @staticmethod
+    def create(config: Optional[dict[str, Any]] = None, openai_api_key: Optional[str] = None) -> Embeddings:
+        """Creates the embedding model of the configuration, by default OpenAI embeddings."""
+        config = dict(config or {})
+        provider = config.pop('provider', EmbeddingProviders.DEFAULT_PROVIDER)
+        if provider not in EmbeddingProviders._providers:
+            raise ValueError(f"Unknown embedding provider {provider}, "
+                             f"expected one of {', '.join(EmbeddingProviders._providers)}")
+        if provider == 'openai':
+            config.setdefault('openai_api_key', openai_api_key)
+        return EmbeddingProviders._providers[provider](**config)
+
+    @staticmethod
+    def embed_queries(embeddings: Embeddings, texts: list[str]) -> list[list[float]]:
+        """Embeds the texts as queries, in one call if the model supports it.
+
+        Models with an :code:`embed_queries` method, like :code:`CachedEmbeddings` and the local models, and OpenAI
+        models, which embed queries like documents, embed all texts in one call. Other models embed them one by one
+        with :code:`embed_query`, since they may embed queries differently from documents.
+        """
+        if not texts:
+            return []
+        if hasattr(embeddings, 'embed_queries'):
+            return embeddings.embed_queries(texts)
+        if isinstance(embeddings, OpenAIEmbeddings):
+            return embeddings.embed_documents(texts)
+        return [embeddings.embed_query(t) for t in texts]
+
+    @staticmethod
+    def _openai(batch_size: Optional[int] = None, **kwargs: Any) -> Embeddings:
+        if batch_size is not None:
+            kwargs['chunk_size'] = batch_size
+        return OpenAIEmbeddings(**kwargs)
+
+
+class LocalEmbeddings(Embeddings):
+    """Base class of embedding models running in the process.
+
+    Texts are embedded :code:`batch_size` at a time, with up to :code:`threads` batches embedded at the same time.
+    Subclasses implement :code:`embed_batch`.
+    """
+
+    DEFAULT_BATCH_SIZE = 64
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE, threads: int = 1):
+        self.batch_size = batch_size
+        self.threads = threads
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=type(self).__name__) \
+            if threads > 1 else None
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if self._executor is None or len(batches) < 2:
+            vectors = [self.embed_batch(b) for b in batches]
+        else:
+            vectors = list(self._executor.map(self.embed_batch, batches))
+        return np.concatenate(vectors).tolist() if vectors else []
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_batch([text])[0].tolist()
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """Embeds the texts as queries, which local models embed like documents."""
+        return self.embed_documents(texts)
+
+    def embed_batch(self, texts: list[str]) -> np.ndarray:
+        """Returns the embeddings of the texts as the rows of a matrix."""
+        raise NotImplementedError
+
+
+class HashingEmbeddings(LocalEmbeddings):
+    """Embeds texts by hashing their words and pairs of consecutive words into a vector of counts.
+
+    Needs no model and no network, so it works anywhere, but only matches texts sharing words. Each word or pair
+    adds or subtracts one at the position given by its CRC-32 checksum, and the vector is normalized.
+    """
+
+    DEFAULT_DIMENSION = 1024
+    WORD_REGEX = re.compile(r"\w+")
+
+    def __init__(self, dimension: int = DEFAULT_DIMENSION, batch_size: int = LocalEmbeddings.DEFAULT_BATCH_SIZE,
+                 threads: int = 1):
+        super().__init__(batch_size=batch_size, threads=threads)
+        self.dimension = dimension
+        self.model_name = f"hashing-{dimension}"
+
+    def embed_batch(self, texts: list[str]) -> np.ndarray:
+        rows, checksums = [], []
+        for i, text in enumerate(texts):
+            words = HashingEmbeddings.WORD_REGEX.findall(text.casefold())
+            features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            checksums.extend(zlib.crc32(f.encode('utf-8')) for f in features)
+            rows.extend([i] * len(features))
+        checksums = np.asarray(checksums, dtype=np.int64)
+        signs = np.where(checksums >> 31, -1.0, 1.0).astype(np.float32)
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        np.add.at(vectors, (np.asarray(rows, dtype=np.int64), checksums % self.dimension), signs)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+
+class SentenceTransformerEmbeddings(LocalEmbeddings):
+    """Embeds texts with a sentence-transformers model on the CPU.
+
+    Requires the :code:`sentence-transformers` package. The model is loaded on first use, downloaded unless
+    :code:`model_name` is the path of a local copy. Pass :code:`backend="onnx"` to run the model with ONNX Runtime,
+    if the installed version supports it.
+    """
+
+    DEFAULT_MODEL = "all-MiniLM-L6-v2"
+
+    def __init__(self, model_name: str = DEFAULT_MODEL, device: str = "cpu", backend: Optional[str] = None,
+                 batch_size: int = LocalEmbeddings.DEFAULT_BATCH_SIZE, threads: int = 1):
+        if sentence_transformers is None:
+            raise ImportError("The sentence-transformers embedding provider requires the sentence-transformers "
+                              "package, install it with pip install sentence-transformers")
+        super().__init__(batch_size=batch_size, threads=threads)
+        self.model_name = model_name
+        self.device = device
+        self.backend = backend
+        self._model = None
+        self._lock = threading.Lock()
+
+    def model(self) -> "sentence_transformers.SentenceTransformer":
+        """Returns the model, loading it on first use."""
+        with self._lock:
+            if self._model is None:
+                kwargs = {'backend': self.backend} if self.backend is not None else {}
+                self._model = sentence_transformers.SentenceTransformer(self.model_name, device=self.device,
+                                                                        **kwargs)
+            return self._model
+
+    def embed_batch(self, texts: list[str]) -> np.ndarray:
+        return self.model().encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                   normalize_embeddings=True)
+
+
+EmbeddingProviders.register('openai', EmbeddingProviders._openai)
+EmbeddingProviders.register('sentence-transformers', SentenceTransformerEmbeddings)
+EmbeddingProviders.register('hashing', HashingEmbeddings)
@@ -1,12 +1,24 @@
+import copy
+import logging
 import re
-from typing import Any
+from typing import Any, Optional
+from langchain.schema import Document
 from langchain.text_splitter import TextSplitter
 
+logger = logging.getLogger(__name__)
+
 
 class SentenceTextSplitter(TextSplitter):
-    """Splits text along sentence boundaries."""
+    """Splits text along sentence boundaries.
+
+    A sentence ends after a run of separators, see :code:`SPLIT_PATTERN`. Consecutive sentences are merged into
+    chunks of at most :code:`chunk_size`, each chunk starting with the last sentences of the previous chunk, up to
+    :code:`chunk_overlap`, like langchain's :code:`_merge_splits` with an empty separator. The chunks are found in a
+    single pass over sentence offsets, and their start indexes are exact.
+    """
 
     SPLIT_PATTERN = "[.?!]|\n\n"
+    SPLIT_REGEX = re.compile(SPLIT_PATTERN)
 
     def __init__(self,
                  chunk_size: int = 1200,
@@ -17,20 +29,77 @@ class SentenceTextSplitter(TextSplitter):
                          keep_separator=True, **kwargs)
 
     def split_text(self, text: str) -> list[str]:
-        first_splits = self.split_on_pattern(text)
-        sentences = self.append_separators(first_splits)
-        return self._merge_splits(sentences, separator="")
-
-    def split_on_pattern(self, text: str) -> list[str]:
-        return [s for s in re.split(f"({self.SPLIT_PATTERN})", text) if s]
-
-    def append_separators(self, splits: list[str]) -> list[str]:
-        concatenated = []
-        for s in splits:
-            if concatenated and re.fullmatch(self.SPLIT_PATTERN, s):
-                concatenated[-1] += s
-            else:
-                concatenated.append(s)
-        return concatenated
+        return [chunk for _, chunk in self.split_text_with_offsets(text)]
+
+    def create_documents(self, texts: list[str], metadatas: Optional[list[dict]] = None) -> list[Document]:
+        """Creates documents from the chunks of the texts, with the offsets of the chunks as start indexes."""
+        _metadatas = metadatas or [{}] * len(texts)
+        documents = []
+        for text, text_metadata in zip(texts, _metadatas):
+            for start, chunk in self.split_text_with_offsets(text):
+                metadata = copy.deepcopy(text_metadata)
+                if self._add_start_index:
+                    metadata["start_index"] = start
+                documents.append(Document(page_content=chunk, metadata=metadata))
+        return documents
 
+    def split_text_with_offsets(self, text: str) -> list[tuple[int, str]]:
+        """Returns the chunks of the text with their start offsets."""
+        ends = self.sentence_ends(text)
+        if not ends:
+            return []
+        starts = [0] + ends[:-1]
+        if self._length_function is len:
+            lengths = [end - start for start, end in zip(starts, ends)]
+        else:
+            lengths = [self._length_function(text[start:end]) for start, end in zip(starts, ends)]
+
+        # Like langchain, count the length of the empty separator between sentences, which is 0 for len
+        separator_length = self._length_function("")
+        chunks = []
+        first = 0
+        total = 0
+        for i, length in enumerate(lengths):
+            if total + length + (separator_length if i > first else 0) > self._chunk_size:
+                if total > self._chunk_size:
+                    logger.warning(f"Created a chunk of size {total}, "
+                                   f"which is longer than the specified {self._chunk_size}")
+                if i > first:
+                    self._add_chunk(chunks, text, starts[first], ends[i - 1])
+                    while first < i and (total > self._chunk_overlap or
+                                         (total + length + separator_length > self._chunk_size and total > 0)):
+                        total -= lengths[first] + (separator_length if i - first > 1 else 0)
+                        first += 1
+            total += length + (separator_length if i > first else 0)
+        self._add_chunk(chunks, text, starts[first], ends[-1])
+        return chunks
+
+    def sentence_ends(self, text: str) -> list[int]:
+        """Returns the end offsets of the sentences, the last one being the end of the text.
+
+        Separators directly following each other end the same sentence.
+        """
+        if not text:
+            return []
+        ends = []
+        previous_end = -1
+        for match in self.SPLIT_REGEX.finditer(text):
+            start, end = match.span()
+            if start == previous_end:
+                ends[-1] = end
+            else:
+                ends.append(end)
+            previous_end = end
+        if not ends or ends[-1] < len(text):
+            ends.append(len(text))
+        return ends
 
+    def _add_chunk(self, chunks: list[tuple[int, str]], text: str, start: int, end: int):
+        """Adds the text between the offsets as a chunk, with whitespace stripped, unless it is empty."""
+        chunk = text[start:end]
+        if self._strip_whitespace:
+            stripped = chunk.lstrip()
+            start += len(chunk) - len(stripped)
+            chunk = stripped.rstrip()
+        if chunk:
+            chunks.append((start, chunk))
@@ -1,49 +1,84 @@
-from langchain_community.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
-from langchain.docstore.document import Document
+from pathlib import Path
+from typing import Optional, Any
+
+import numpy as np
+
+from knowledge_net.experimental.database.embedding_cache import CachedEmbeddings
+from knowledge_net.experimental.database.embeddings import EmbeddingProviders
 
 
 class MatchableTexts:
     """Supports similarity search on a collection of texts.
 
     The class is useful when implementing routing where you need to pick one or more knowledge bases with descriptions
-    matching a query.
+    matching a query. Texts and queries are embedded through the embedding cache of the process, so repeated queries
+    aren't embedded again. Pass :code:`embedding_cache_directory` to also keep the cache on disk, and
+    :code:`embeddings` to embed with another provider than OpenAI, see :code:`EmbeddingProviders`.
+
+    The normalized embeddings of the texts are kept as the rows of a matrix, so scoring all texts against a query is
+    one matrix-vector product. Scores are cosine similarities, higher being better.
     """
 
-    collection_id: int = 0
+    def __init__(self, named_texts: dict[str, str], openai_api_key: Optional[str],
+                 embedding_cache_directory: Optional[Path] = None, embeddings: Optional[dict[str, Any]] = None):
+        model = EmbeddingProviders.create(embeddings, openai_api_key=openai_api_key)
+        self.embeddings = CachedEmbeddings.shared(model, directory=embedding_cache_directory)
+        self.names = list(named_texts.keys())
+        vectors = self.embeddings.embed_documents(list(named_texts.values()))
+        self.matrix = MatchableTexts.normalized(np.asarray(vectors, dtype=np.float32)) if vectors else None
 
-    def __init__(self, named_texts: dict[str, str], openai_api_key: str):
-        documents = [Document(page_content=t, metadata={"name": n}) for n, t in named_texts.items()]
-        embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key)
-        unique_name = f"Collection_{MatchableTexts.collection_id}"
-        self.vector_store = Chroma.from_documents(documents, embeddings, collection_name=unique_name)
-        MatchableTexts.collection_id += 1
+    def scores(self, query: str) -> np.ndarray:
+        """Returns the score of each text, in the order of :code:`names`."""
+        if not self.names:
+            return np.zeros(0, dtype=np.float32)
+        return self.matrix @ MatchableTexts.normalized(np.asarray(self.embeddings.embed_query(query), dtype=np.float32))
 
     def search_with_score(self, query: str, k: int = 1) -> list[tuple[str, float]]:
         """Returns the names and scores of the top k matching texts."""
-        return [(d.metadata['name'], s) for d, s in
-                self.vector_store.similarity_search_with_score(query, k=k)]
+        scores = self.scores(query)
+        return [(self.names[i], float(scores[i])) for i in MatchableTexts.top(scores, k)]
 
     def best(self, query: str, k: int = 1) -> list[str]:
         """Returns the names of the top k matching texts."""
-        # Uncomment to print scores for each item
-        # with_scores = self.vector_store.similarity_search_with_score(query, k=k)
-        # print([f"{d.metadata['name']} score = {s}" for d, s in with_scores])
-        return [d.metadata['name'] for d in self.vector_store.similarity_search(query, k=k)]
+        return [name for name, _ in self.search_with_score(query, k=k)]
 
     def better_than(self, query: str, baseline_name: str = "general", k: int = 3) -> list[str]:
         """Returns the names of the texts scoring better than the baseline up to a maximum of k texts."""
-        names = self.best(query, k=k)
-        baseline_index = names.index(baseline_name) if baseline_name in names else k
-        return names[:baseline_index]
+        return self._compare_to_baseline(query, baseline_name, k, or_equal=False)
 
     def better_than_or_equal(self, query: str, baseline_name: str = "general", k: int = 3) -> list[str]:
         """Returns the names of the texts scoring >= the baseline up to a maximum of k texts."""
-        names = self.best(query, k=k)
-        baseline_index = names.index(baseline_name) if baseline_name in names else k
-        return names[:baseline_index + 1]
+        return self._compare_to_baseline(query, baseline_name, k, or_equal=True)
 
     def baseline_or_better(self, query: str, baseline: str = "general", k: int = 3) -> list[str]:
         """Returns the names of the texts scoring better than the baseline, or baseline if none is better, max k."""
         better = self.better_than(query, baseline, k=k)
         return better or [baseline]
+
+    def _compare_to_baseline(self, query: str, baseline_name: str, k: int, or_equal: bool) -> list[str]:
+        """Returns the names of the top k texts scoring better than, or as well as, the baseline text.
+
+        Without a baseline text, returns the names of the top k texts.
+        """
+        scores = self.scores(query)
+        top = MatchableTexts.top(scores, k)
+        if baseline_name not in self.names:
+            return [self.names[i] for i in top]
+        baseline_score = scores[self.names.index(baseline_name)]
+        if or_equal:
+            return [self.names[i] for i in top if scores[i] >= baseline_score]
+        return [self.names[i] for i in top if scores[i] > baseline_score]
+
+    @staticmethod
+    def top(scores: np.ndarray, k: int) -> np.ndarray:
+        """Returns the indexes of the k highest scores, best first."""
+        if k < len(scores):
+            candidates = np.argpartition(-scores, k - 1)[:k] if k > 0 else np.zeros(0, dtype=np.int64)
+            return candidates[np.argsort(-scores[candidates], kind='stable')]
+        return np.argsort(-scores, kind='stable')
+
+    @staticmethod
+    def normalized(vectors: np.ndarray) -> np.ndarray:
+        """Scales the vectors, or the rows of a matrix, to unit length."""
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return np.ascontiguousarray(vectors / np.where(norms > 0, norms, 1))
@@ -1,6 +1,10 @@
-from typing import Tuple, Optional
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextvars import copy_context
+from typing import Tuple, Optional, Any
 
 from knowledge_net.chat.chat_history import ChatHistory
+from knowledge_net.knowledgebase.deadline import Deadline
 from knowledge_net.knowledgebase.knowledgebase import Knowledgebase
 from knowledge_net.chat.chat_event import SummaryType, MessageEvent
 
@@ -11,26 +15,123 @@ from knowledge_net.experimental.routing_knowledgebase.matchable_texts import Mat
 class RoutingKnowledgebase(Knowledgebase):
     """Knowledgebase that synthesizes the replies of connected knowledgebases.
 
-    The knowledgebases to be consulted are selected based on the user's question."""
+    The knowledgebases to be consulted are selected based on the user's question. By default, the selected
+    knowledgebases are called concurrently on a thread pool of the reply, with at most :code:`max_workers` threads,
+    so that the reply takes as long as the slowest branch rather than the sum of all branches. Set :code:`concurrent`
+    to false to call them one after another. Concurrent branches share a deadline :code:`branch_timeout` seconds
+    from the moment they are dispatched, so branches waiting for a thread get no extra time; called one after
+    another, each branch gets :code:`branch_timeout` seconds from its start. The deadline also cuts off the calls the
+    branches make to other knowledgebases. A branch that fails or doesn't reply in time is shown with its error.
+
+    The descriptions of the knowledgebases are embedded with the provider configured in :code:`embeddings`, by
+    default OpenAI, see :code:`EmbeddingProviders`."""
+
+    DEFAULT_MAX_WORKERS = 4
+    """Default number of knowledgebases called at the same time for one reply"""
+
+    TIMED_OUT = "No reply before the deadline"
 
     def __init__(self,
                  identifier: str,
                  openai_api_key: str,
                  display_name: Optional[str] = None,
-                 description: str = None):
+                 description: str = None,
+                 concurrent: bool = True,
+                 max_workers: int = DEFAULT_MAX_WORKERS,
+                 branch_timeout: Optional[float] = None,
+                 embeddings: Optional[dict[str, Any]] = None):
         super().__init__(identifier, display_name, description)
         self.openai_api_key = openai_api_key
+        self.embeddings = embeddings
         self.chat_summarizer: ChatSummarizer = ChatSummarizer(openai_api_key=openai_api_key)
         self.knowledgebase_descriptions: Optional[MatchableTexts] = None
+        self.concurrent = concurrent
+        self.branch_timeout = branch_timeout
+        self.max_workers = max_workers
 
     def _reply(self, chat_history: ChatHistory) -> Tuple[ChatHistory, Optional[str]]:
         """Replies by aggregating the replies from selected knowledgebases."""
         query = self._prepare_routing_query(chat_history)
         relevant_knowledgebases = self._select_knowledgebases(query)
-        replies = [kb.reply(chat_history) for kb in relevant_knowledgebases]
+        replies = self._call_knowledgebases(relevant_knowledgebases, chat_history)
+        message = self._combine_replies(relevant_knowledgebases, replies)
+        return ChatHistory([message]), None
+
+    async def _areply(self, chat_history: ChatHistory) -> Tuple[ChatHistory, Optional[str]]:
+        """Replies by aggregating the replies from selected knowledgebases, awaiting them all at once."""
+        query = await self._aprepare_routing_query(chat_history)
+        relevant_knowledgebases = await asyncio.to_thread(self._select_knowledgebases, query)
+        replies = await self._acall_knowledgebases(relevant_knowledgebases, chat_history)
         message = self._combine_replies(relevant_knowledgebases, replies)
         return ChatHistory([message]), None
 
+    def _call_knowledgebases(self, knowledgebases: list[Knowledgebase], chat_history: ChatHistory) \
+            -> list[ChatHistory]:
+        """Calls the knowledgebases and returns their replies in the same order.
+
+        Each knowledgebase gets its own copy of the chat history. Knowledgebases that raise an exception, or don't
+        reply within :code:`branch_timeout` seconds or before the deadline of this reply, are represented by a reply
+        with the error.
+        """
+        if not self.concurrent:
+            replies = []
+            for kb in knowledgebases:
+                with Deadline.scope(self.branch_timeout):
+                    replies.append(self._call_branch(kb, chat_history))
+            return replies
+        if not knowledgebases:
+            return []
+
+        # A pool per reply, so that branches abandoned by one reply never hold up the branches of another
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(knowledgebases)),
+                                      thread_name_prefix=self.identifier)
+        try:
+            with Deadline.scope(self.branch_timeout):
+                futures = [executor.submit(copy_context().run, self._call_branch, kb, chat_history)
+                           for kb in knowledgebases]
+                wait(futures, timeout=Deadline.remaining())
+            replies = []
+            for kb, future in zip(knowledgebases, futures):
+                if future.done():
+                    replies.append(future.result())
+                else:
+                    future.cancel()
+                    replies.append(self._error_reply(kb, chat_history, RoutingKnowledgebase.TIMED_OUT))
+            return replies
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _call_branch(self, knowledgebase: Knowledgebase, chat_history: ChatHistory) -> ChatHistory:
+        """Calls the knowledgebase with a copy of the chat history, turning an exception into an error reply."""
+        try:
+            return knowledgebase.reply(chat_history.copy(), caller=self.identifier)
+        except Exception as e:
+            return self._error_reply(knowledgebase, chat_history, f"{type(e).__name__}: {e}")
+
+    async def _acall_knowledgebases(self, knowledgebases: list[Knowledgebase], chat_history: ChatHistory) \
+            -> list[ChatHistory]:
+        """Asynchronous version of :code:`_call_knowledgebases`, always concurrent.
+
+        Knowledgebases that don't reply in time are cancelled.
+        """
+        timeout = Deadline.budget(self.branch_timeout)
+
+        async def call(kb: Knowledgebase) -> ChatHistory:
+            try:
+                with Deadline.scope(self.branch_timeout):
+                    return await asyncio.wait_for(kb.areply(chat_history.copy(), caller=self.identifier), timeout)
+            except asyncio.TimeoutError:
+                return self._error_reply(kb, chat_history, RoutingKnowledgebase.TIMED_OUT)
+            except Exception as e:
+                return self._error_reply(kb, chat_history, f"{type(e).__name__}: {e}")
+
+        return list(await asyncio.gather(*(call(kb) for kb in knowledgebases)))
+
+    def _error_reply(self, knowledgebase: Knowledgebase, chat_history: ChatHistory, error: str) -> ChatHistory:
+        """Produces the reply of a knowledgebase that failed or didn't answer in time."""
+        call = chat_history.copy().with_call_event(caller=self.identifier, called=knowledgebase.identifier)
+        return ChatHistory.error(call, error)
+
     def _prepare_routing_query(self, chat_history: ChatHistory) -> str:
         """Computes a query with which the relevant knowledgebases will be selected."""
         self.chat_summarizer.add_summary_if_missing(chat_history, originator=self.identifier,
@@ -39,6 +140,14 @@ class RoutingKnowledgebase(Knowledgebase):
         assert query is not None
         return query
 
+    async def _aprepare_routing_query(self, chat_history: ChatHistory) -> str:
+        """Asynchronous version of :code:`_prepare_routing_query`."""
+        await self.chat_summarizer.aadd_summary_if_missing(chat_history, originator=self.identifier,
+                                                           summary_type=SummaryType.standalone_question)
+        query = chat_history.get_last_question()
+        assert query is not None
+        return query
+
     def _select_knowledgebases(self, query: str) -> list[Knowledgebase]:
         """Picks relevant knowledgebases based on the query."""
         names = self.knowledgebase_descriptions.baseline_or_better(query=query, k=4)
@@ -55,10 +164,12 @@ class RoutingKnowledgebase(Knowledgebase):
             From Recent History:
             The president was very old...
 
+        Knowledgebases that returned an error, such as not replying in time, are shown with the error.
+
         Override this method for more advanced aggregation or different formatting."""
 
-        message_text_lists = [[m.message_text for m in r.get_messages()] for r in replies]
-        concatenated = ['\n\n'.join(text_list) for text_list in message_text_lists]
+        concatenated = [f"*Error: {r.get_error()[1]}*" if r.returned_error()
+                        else '\n\n'.join(m.message_text for m in r.get_messages()) for r in replies]
         display_names = [kb.display_name for kb in knowledge_bases]
         prefixed = [f"From **{name}**:\n\n{m}" for name, m in zip(display_names, concatenated)]
         return self.message('\n\n'.join(prefixed))
@@ -67,4 +178,4 @@ class RoutingKnowledgebase(Knowledgebase):
         """Sets the connected knowledgebases and similarity-searchable knowledgebase descriptions."""
         super().set_connected_knowledgebases(knowledgebases)
         d = {identifier: kb.description for identifier, kb in self._connected_knowledgebases.items()}
-        self.knowledgebase_descriptions = MatchableTexts(d, self.openai_api_key)
+        self.knowledgebase_descriptions = MatchableTexts(d, self.openai_api_key, embeddings=self.embeddings)
@@ -29,6 +29,10 @@ class ChatSummarizer:
         langchain_question = Conversions.chat_history_to_langchain_question(chat_history)
         return self.standalone_question_chain(langchain_question)['text'].strip()
 
+    async def amake_standalone_question(self, chat_history: ChatHistory) -> str:
+        langchain_question = Conversions.chat_history_to_langchain_question(chat_history)
+        return (await self.standalone_question_chain.ainvoke(langchain_question))['text'].strip()
+
     def add_standalone_question(self, chat_history: ChatHistory, originator):
         chat_history.append(SummaryEvent(summary_type=SummaryType.standalone_question,
                                          summary_text=self.make_standalone_question(chat_history),
@@ -49,3 +53,16 @@ class ChatSummarizer:
                                summary_type=SummaryType.standalone_question):
         if chat_history.has_messages() and not chat_history.has_summary(summary_type):
             self.add_summary_of_type(chat_history, originator, summary_type)
+
+    async def amake_summary_of_type(self, chat_history: ChatHistory,
+                                    summary_type=SummaryType.standalone_question) -> str:
+        if summary_type == "standalone-question":
+            return await self.amake_standalone_question(chat_history)
+        raise ValueError(f"Unknown summary type {summary_type}")
+
+    async def aadd_summary_if_missing(self, chat_history: ChatHistory, originator,
+                                      summary_type=SummaryType.standalone_question):
+        if chat_history.has_messages() and not chat_history.has_summary(summary_type):
+            chat_history.append(SummaryEvent(summary_type=summary_type,
+                                             summary_text=await self.amake_summary_of_type(chat_history, summary_type),
+                                             originator=originator))
@@ -0,0 +1,92 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Iterator, Generator, TypeVar
+
+Y = TypeVar('Y')
+R = TypeVar('R')
+
+
+class Deadline:
+    """
+    All-static class keeping track of the time left to produce the current reply.
+
+    A knowledge base called with a time out sets a deadline while it works on its reply. Calls it makes to other
+    knowledge bases are given at most the time remaining until the deadline, so that the whole call tree stops
+    waiting when the original caller does. The deadline is stored in a context variable and follows the reply
+    through threads started with a copy of the context and through asyncio tasks.
+    """
+
+    _deadline: ContextVar[Optional[float]] = ContextVar("knowledge_net_deadline", default=None)
+
+    @staticmethod
+    def remaining() -> Optional[float]:
+        """Returns the seconds left until the deadline, or None if there is no deadline."""
+        deadline = Deadline._deadline.get()
+        return None if deadline is None else deadline - time.monotonic()
+
+    @staticmethod
+    def budget(timeout: Optional[float]) -> Optional[float]:
+        """Returns the time out for a call, limited by the remaining time.
+
+        A time out of None or 0 means no limit, like in :code:`scope`. Returns None if there is no limit.
+        """
+        remaining = Deadline.remaining()
+        if not timeout:
+            return remaining
+        if remaining is None:
+            return timeout
+        return min(timeout, remaining)
+
+    @staticmethod
+    @contextmanager
+    def scope(timeout: Optional[float]) -> Iterator[None]:
+        """Sets a deadline :code:`timeout` seconds from now for the duration of the context.
+
+        The deadline never moves later than an enclosing deadline. A time out of None or 0 sets no deadline.
+        """
+        with Deadline._until(time.monotonic() + timeout if timeout else None):
+            yield
+
+    @staticmethod
+    def scoped_generator(generator: Generator[Y, None, R], timeout: Optional[float]) -> Generator[Y, None, R]:
+        """Runs the generator with a deadline :code:`timeout` seconds from now, like :code:`scope`.
+
+        The deadline is only set while the generator runs, between the moments it is resumed and it yields, and
+        not in the context of the consumer between items. A :code:`with Deadline.scope` around a :code:`yield`
+        would leak the deadline to the consumer, and fail if the generator is closed from another context.
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        value, error = None, None
+        while True:
+            with Deadline._until(deadline):
+                try:
+                    item = generator.send(value) if error is None else generator.throw(error)
+                except StopIteration as stop:
+                    return stop.value
+            value, error = None, None
+            try:
+                value = yield item
+            except GeneratorExit:
+                with Deadline._until(deadline):
+                    generator.close()
+                raise
+            except BaseException as e:
+                error = e
+
+    @staticmethod
+    @contextmanager
+    def _until(deadline: Optional[float]) -> Iterator[None]:
+        """Sets the deadline, a :code:`time.monotonic` time, for the duration of the context, unless it is None.
+
+        The deadline never moves later than an enclosing deadline.
+        """
+        if deadline is None:
+            yield
+            return
+        enclosing = Deadline._deadline.get()
+        token = Deadline._deadline.set(deadline if enclosing is None else min(deadline, enclosing))
+        try:
+            yield
+        finally:
+            Deadline._deadline.reset(token)
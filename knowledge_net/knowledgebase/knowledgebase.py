@@ -1,10 +1,14 @@
+import asyncio
 import json
 from importlib import import_module
 from pathlib import Path
-from typing import Any, Optional, Tuple
+from typing import Any, Optional, Tuple, Union, Generator
+from knowledge_net.chat.chat_codec import ChatCodec
 from knowledge_net.chat.chat_event import MessageEvent, Role
 from knowledge_net.chat.chat_history import ChatHistory
+from knowledge_net.chat.reply_stream import ReplyStream
 from knowledge_net.comm_shell.comm_shell import CommShell
+from knowledge_net.knowledgebase.deadline import Deadline
 
 
 class Knowledgebase:
@@ -16,9 +20,12 @@ class Knowledgebase:
 
     Knowledge bases can also run locally, in the same process as the caller. To implement a local knowledge base,
     subclass :code:`Knowledgebase` and implement the :code:`_reply` method.
+
+    The handler of a remote protocol is looked up when the knowledge base is created, so a misspelled or missing
+    protocol raises ValueError right away.
     """
 
-    DEFAULT_REPLY_TIMEOUT = 3
+    DEFAULT_REPLY_TIMEOUT = 60
     """Default reply time out in seconds"""
 
     _public_knowledgebases: dict[str, "Knowledgebase"] = {}
@@ -33,30 +40,142 @@ class Knowledgebase:
                  description: str = None,
                  protocol: str = 'local',
                  protocol_details: Optional[Any] = None,
-                 reply_timeout: int = DEFAULT_REPLY_TIMEOUT):
+                 reply_timeout: Optional[float] = DEFAULT_REPLY_TIMEOUT):
         self.identifier = identifier
         self.display_name = display_name or identifier
         self.description = description
         self.protocol = protocol
+        if protocol != 'local':
+            CommShell.handler(protocol)
         self._protocol_details = protocol_details
         self.reply_timeout = reply_timeout
         self._connected_knowledgebases = {}
 
     def reply(self, chat_history: ChatHistory, caller: str = "user") -> ChatHistory:
-        """Calls the knowledge base and returns the continuation of the chat history."""
+        """Calls the knowledge base and returns the continuation of the chat history.
+
+        The call is given :code:`reply_timeout` seconds, or less if the caller is itself replying under a deadline.
+        The time out is recorded in the call event, which carries it to remote knowledge bases.
+        """
 
-        chat_history.with_call_event(caller=caller, called=self.identifier)
+        timeout, expired = self._begin_call([chat_history], caller)
+        if expired:
+            return expired[0]
         if self.protocol == 'local':
-            continuation, error = self._reply(chat_history.copy())
+            with Deadline.scope(timeout):
+                continuation, error = self._reply(chat_history.copy())
         else:
             continuation, error = CommShell.reply(self.identifier, chat_history, self.protocol, self._protocol_details,
-                                                  timeout=self.reply_timeout)
+                                                  timeout=timeout)
         return continuation.with_return_event(chat_history, error=error or "")
 
+    async def areply(self, chat_history: ChatHistory, caller: str = "user") -> ChatHistory:
+        """Asynchronous version of :code:`reply`.
+
+        Remote knowledge bases are called without blocking the event loop when the protocol supports it, local ones
+        run :code:`_areply`. Deadlines work as in :code:`reply`, each task keeping its own.
+        """
+
+        timeout, expired = self._begin_call([chat_history], caller)
+        if expired:
+            return expired[0]
+        if self.protocol == 'local':
+            with Deadline.scope(timeout):
+                continuation, error = await self._areply(chat_history.copy())
+        else:
+            continuation, error = await CommShell.areply(self.identifier, chat_history, self.protocol,
+                                                         self._protocol_details, timeout=timeout)
+        return continuation.with_return_event(chat_history, error=error or "")
+
+    def reply_batch(self, chat_histories: list[ChatHistory], caller: str = "user") -> list[ChatHistory]:
+        """Calls the knowledge base with many chat histories at once and returns the continuations in order.
+
+        Remote knowledge bases get all chat histories in a single request. Local knowledge bases implementing
+        :code:`_reply_batch` can share work between them, like embedding all questions in one call. The whole batch
+        is given :code:`reply_timeout` seconds.
+        """
+
+        timeout, expired = self._begin_call(chat_histories, caller)
+        if expired:
+            return expired
+        if self.protocol == 'local':
+            with Deadline.scope(timeout):
+                results = self._reply_batch([h.copy() for h in chat_histories])
+        else:
+            results = CommShell.reply_batch(self.identifier, chat_histories, self.protocol, self._protocol_details,
+                                            timeout=timeout)
+        return [continuation.with_return_event(chat_history, error=error or "")
+                for chat_history, (continuation, error) in zip(chat_histories, results)]
+
+    def reply_stream(self, chat_history: ChatHistory, caller: str = "user") -> ReplyStream:
+        """Calls the knowledge base and streams the reply.
+
+        Iterate over the returned stream to get the reply text piece by piece, then take the continuation of the
+        chat history from its :code:`continuation` attribute. Knowledge bases that don't support streaming deliver
+        their reply in a single piece.
+        """
+        return ReplyStream(self._reply_stream_with_events(chat_history, caller))
+
+    def _reply_stream_with_events(self, chat_history: ChatHistory, caller: str) \
+            -> Generator[MessageEvent, None, ChatHistory]:
+        """Streams the reply, adding call and return events like :code:`reply`."""
+
+        timeout, expired = self._begin_call([chat_history], caller)
+        if expired:
+            return expired[0]
+        if self.protocol == 'local':
+            continuation, error = yield from Deadline.scoped_generator(self._reply_stream(chat_history.copy()),
+                                                                       timeout)
+        else:
+            continuation, error = yield from CommShell.reply_stream(self.identifier, chat_history, self.protocol,
+                                                                    self._protocol_details, timeout=timeout)
+        return continuation.with_return_event(chat_history, error=error or "")
+
+    def _begin_call(self, chat_histories: list[ChatHistory], caller: str) \
+            -> Tuple[Optional[float], Optional[list[ChatHistory]]]:
+        """Adds the call events and returns the time out of the call, None for no limit.
+
+        The time out is :code:`reply_timeout`, where None or 0 means no limit, cut to the time left until the
+        deadline of the caller. If the deadline has already passed, the error replies to the chat histories are
+        returned as well, and the call should not be made.
+        """
+        timeout = Deadline.budget(self.reply_timeout)
+        for chat_history in chat_histories:
+            chat_history.with_call_event(caller=caller, called=self.identifier, time_out_seconds=timeout or 0)
+        if timeout is not None and timeout <= 0:
+            return timeout, [ChatHistory.error(h, "Deadline exceeded before the call") for h in chat_histories]
+        return timeout, None
+
     def _reply(self, chat_history: ChatHistory) -> Tuple[ChatHistory, Optional[str]]:
         """Override this to define the behavior of your knowledgebase."""
         raise NotImplementedError("Need to reimplement _reply to create a knowledgebase")
 
+    def _reply_batch(self, chat_histories: list[ChatHistory]) -> list[Tuple[ChatHistory, Optional[str]]]:
+        """Override this to reply to many chat histories more efficiently than one by one.
+
+        Return the continuation and error for each chat history, in order. By default, calls :code:`_reply` for
+        each chat history.
+        """
+        return [self._reply(chat_history) for chat_history in chat_histories]
+
+    async def _areply(self, chat_history: ChatHistory) -> Tuple[ChatHistory, Optional[str]]:
+        """Override this to reply without blocking the event loop.
+
+        By default, runs :code:`_reply` in a worker thread.
+        """
+        return await asyncio.to_thread(self._reply, chat_history)
+
+    def _reply_stream(self, chat_history: ChatHistory) \
+            -> Generator[MessageEvent, None, Tuple[ChatHistory, Optional[str]]]:
+        """Override this to stream the reply of your knowledgebase.
+
+        Yield message events holding pieces of the reply text and return the continuation and error like
+        :code:`_reply`. By default, calls :code:`_reply` and yields the reply in one piece.
+        """
+        continuation, error = self._reply(chat_history)
+        yield from ReplyStream.message_deltas(continuation)
+        return continuation, error
+
     @staticmethod
     def clear_public_knowledgebases():
         """Empties the list of public knowledgebases."""
@@ -166,10 +285,18 @@ class Knowledgebase:
         return Knowledgebase(**d)
 
     @staticmethod
-    def kb_and_history_from_json(json_data: str) -> Tuple["Knowledgebase", ChatHistory, str]:
+    def kb_and_history_from_json(json_data: Union[str, bytes]) -> Tuple["Knowledgebase", ChatHistory, str]:
         """Returns Knowledgebase and ChatHistory objects from json data."""
 
-        data_dict = json.loads(json_data)  # Will raise ValueError if not valid json
+        data_dict = ChatCodec.loads(json_data)  # Will raise ValueError if not valid json
+        return Knowledgebase.kb_and_history_from_dict(data_dict)
+
+    @staticmethod
+    def kb_and_history_from_dict(data_dict: dict[str, Any]) -> Tuple["Knowledgebase", ChatHistory, str]:
+        """Returns Knowledgebase and ChatHistory objects from a dictionary decoded from json data."""
+
+        if not isinstance(data_dict, dict):
+            raise ValueError("Expected a json object")
         if 'knowledgebase' not in data_dict:
             raise ValueError("Knowledgebase key ('knowledgebase') required")
         if 'chat_history' not in data_dict:
@@ -187,6 +314,34 @@ class Knowledgebase:
         chat_history: ChatHistory = ChatHistory.from_dict_list(data_dict['chat_history'])
         return knowledgebase, chat_history, error
 
+    @staticmethod
+    def kb_and_histories_from_dict(data_dict: dict[str, Any]) -> Tuple["Knowledgebase", list[ChatHistory], str]:
+        """Returns the Knowledgebase and list of ChatHistory objects of a batch request decoded from json data."""
+
+        if not isinstance(data_dict, dict):
+            raise ValueError("Expected a json object")
+        if 'knowledgebase' not in data_dict:
+            raise ValueError("Knowledgebase key ('knowledgebase') required")
+        if not isinstance(data_dict.get('chat_histories'), list):
+            raise ValueError("Chat history list key ('chat_histories') required")
+
+        kb_name = data_dict['knowledgebase']
+
+        error: str = ""
+        knowledgebase: Optional["Knowledgebase"] = None
+
+        if Knowledgebase.has_public_knowledgebase(kb_name):
+            knowledgebase = Knowledgebase.public_knowledgebase_by_name(kb_name)
+        else:
+            error = f"Knowledge base {kb_name} not found"
+        chat_histories = [ChatHistory.from_dict_list(d) for d in data_dict['chat_histories']]
+        return knowledgebase, chat_histories, error
+
+    @staticmethod
+    def kb_and_histories_as_json_bytes(kb_name: str, chat_histories: list[ChatHistory]) -> bytes:
+        """Creates a UTF-8 encoded json representation of a batch request."""
+        return ChatCodec.dumps({'knowledgebase': kb_name, 'chat_histories': [h.to_dict_list() for h in chat_histories]})
+
     @staticmethod
     def kb_and_history_as_dict(kb_name: str, chat_history: ChatHistory) -> dict[str, Any]:
         """Creates a dictionary representation of the knowledge base name and the chat history."""
@@ -195,7 +350,12 @@ class Knowledgebase:
     @staticmethod
     def kb_and_history_as_json(kb_name: str, chat_history: ChatHistory) -> str:
         """Creates a json representation of the knowledge base name and the chat history."""
-        return json.dumps(Knowledgebase.kb_and_history_as_dict(kb_name, chat_history))
+        return Knowledgebase.kb_and_history_as_json_bytes(kb_name, chat_history).decode('utf-8')
+
+    @staticmethod
+    def kb_and_history_as_json_bytes(kb_name: str, chat_history: ChatHistory) -> bytes:
+        """Creates a UTF-8 encoded json representation of the knowledge base name and the chat history."""
+        return ChatCodec.dumps(Knowledgebase.kb_and_history_as_dict(kb_name, chat_history))
 
     @staticmethod
     def has_public_knowledgebase(kb_name: str) -> bool:
@@ -1,14 +1,39 @@
+from typing import Union, Sequence, Any
 from langchain.schema import Document
 from knowledge_net.langchain.metadata_group import MetadataGroup
 
 
 class DocumentGroupTransform:
-    """Callable that transforms document lists according to their metadata."""
+    """Callable that transforms document lists according to their metadata.
 
-    def __init__(self, key: str, descriptions: dict[str, dict[str, dict[str, str]]]):
+    Documents are grouped by the metadata :code:`key`, or by several keys given as a list, e.g.
+    :code:`['source', 'chapter']`. Each group becomes one document introduced from the :code:`descriptions` of its
+    source, with its chunks in the order of their start index if :code:`order_by_start_index` is set.
+
+    With :code:`merge_overlapping`, chunks of a group whose text overlaps or follows directly in the source are
+    merged into one quote, so that the overlap between chunks is not repeated in the prompt. This needs the
+    :code:`start_index` metadata of the splitter and puts the chunks in the order of their start index.
+    """
+
+    def __init__(self,
+                 key: Union[str, Sequence[str]],
+                 descriptions: dict[str, dict[str, dict[str, str]]],
+                 order_by_start_index: bool = False,
+                 merge_overlapping: bool = False):
         self.key = key
         self.descriptions = descriptions
+        self.order_by_start_index = order_by_start_index
+        self.merge_overlapping = merge_overlapping
+
+    def group_value(self, document: Document) -> Any:
+        """Returns the value of the metadata key, or keys, that the document is grouped by."""
+        return MetadataGroup.document_value_from_key(document,
+                                                     self.key if isinstance(self.key, str) else tuple(self.key))
 
     def __call__(self, documents: list[Document]) -> list[Document]:
-        groups = MetadataGroup.group_documents_by_key(documents, self.key)
+        groups = MetadataGroup.group_documents_by_key(documents, self.key,
+                                                      order_by_start_index=self.order_by_start_index)
+        if self.merge_overlapping:
+            for g in groups:
+                g.merge_overlapping()
         return [g.to_document_with_book_intro(descriptions=self.descriptions) for g in groups]
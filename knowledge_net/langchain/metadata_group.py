@@ -1,11 +1,18 @@
-from typing import Optional, Any
+from typing import Optional, Any, Union, Sequence
 from langchain.schema import Document
 
+GroupKey = Union[str, tuple[str, ...]]
+"""A metadata key, or a tuple of keys for grouping by several keys at once"""
+
 
 class MetadataGroup:
-    """Groups documents with similar metadata."""
+    """Groups documents with similar metadata.
+
+    The key is a single metadata key, or a tuple of keys such as :code:`('source', 'chapter')`, in which case the
+    value is the tuple of the values of the keys.
+    """
 
-    def __init__(self, key: str, value: str, documents: list[Document]):
+    def __init__(self, key: GroupKey, value: Any, documents: list[Document]):
         """Initializes group of documents where metadata[key] == value."""
         self.key = key
         self.value = value
@@ -55,35 +62,80 @@ class MetadataGroup:
         return Document(page_content=content)
 
     def get_from_dictionary(self, dictionary: dict[str, dict[str, Any]]) -> Any:
-        """Retrieves a dictionary value corresponding to the group's key and value."""
-        return dictionary[self.key][self.value] if self.key in dictionary and self.value in dictionary[self.key] else ""
+        """Retrieves a dictionary value corresponding to the group's key and value.
+
+        When grouping by several keys, the value is looked up by the first key, e.g. the source of a chapter.
+        """
+        key, value = (self.key[0], self.value[0]) if isinstance(self.key, tuple) else (self.key, self.value)
+        return dictionary[key][value] if key in dictionary and value in dictionary[key] else ""
+
+    def sort_by_start_index(self):
+        """Puts the documents in the order of their start index. Documents without one keep their order, last."""
+        self.documents.sort(key=MetadataGroup.start_index_order)
+
+    def merge_overlapping(self):
+        """Merges documents with overlapping or adjacent text, see :code:`merge_overlapping_documents`."""
+        self.documents = MetadataGroup.merge_overlapping_documents(self.documents)
 
     @staticmethod
-    def document_value_from_key(document: Document, key: str):
+    def merge_overlapping_documents(documents: list[Document]) -> list[Document]:
+        """Puts the documents in the order of their start index and merges overlapping or adjacent ones.
+
+        A document is merged into the previous one when it starts before or where the previous one ends and their
+        texts agree where they overlap. A merged document keeps the metadata of its first part. Documents without a
+        start index are kept as they are, last.
+        """
+        merged: list[Document] = []
+        last_start: Optional[int] = None
+        for d in sorted(documents, key=MetadataGroup.start_index_order):
+            start = d.metadata.get('start_index')
+            if start is not None and last_start is not None and start <= last_start + len(merged[-1].page_content):
+                last = merged[-1]
+                overlap = last.page_content[start - last_start:]
+                if d.page_content.startswith(overlap):
+                    merged[-1] = Document(page_content=last.page_content + d.page_content[len(overlap):],
+                                          metadata=last.metadata)
+                    continue
+                if overlap.startswith(d.page_content):
+                    continue
+            merged.append(Document(page_content=d.page_content, metadata=dict(d.metadata)))
+            last_start = start
+        return merged
+
+    @staticmethod
+    def start_index_order(document: Document) -> tuple[bool, int]:
+        """Sort key putting documents in the order of their start index, those without one last."""
+        start_index = document.metadata.get('start_index')
+        return start_index is None, start_index or 0
+
+    @staticmethod
+    def document_value_from_key(document: Document, key: GroupKey):
         """Gets the value of the document as defined by the key."""
+        if isinstance(key, tuple):
+            return tuple(document.metadata.get(k) for k in key)
         return document.metadata[key] if key in document.metadata else None
 
     @staticmethod
-    def group_documents_by_key(documents: list[Document], key: str) -> list["MetadataGroup"]:
-        """Creates list of groups, each containing documents with equal values for metadata[key]."""
-        groups: list[MetadataGroup] = []
+    def group_documents_by_key(documents: list[Document],
+                               key: Union[str, Sequence[str]],
+                               order_by_start_index: bool = False) -> list["MetadataGroup"]:
+        """Creates list of groups, each containing documents with equal values for metadata[key].
+
+        With a sequence of keys, documents are grouped by the values of all the keys. Groups are in the order of
+        their first document. With :code:`order_by_start_index`, the documents of each group are put in the order
+        of their start index, otherwise they keep the order of the input.
+        """
+        key = key if isinstance(key, str) else tuple(key)
+        groups: dict[Any, MetadataGroup] = {}
         for d in documents:
-            matching_group: Optional[MetadataGroup] = MetadataGroup.find_matching_group(d, groups)
-            if matching_group:
-                matching_group.add(d)
+            value = MetadataGroup.document_value_from_key(d, key)
+            group = groups.get(value)
+            if group is None:
+                groups[value] = MetadataGroup(key=key, value=value, documents=[d])
             else:
-                value = MetadataGroup.document_value_from_key(d, key)
-                new_group = MetadataGroup(key=key, value=value, documents=[d])
-                groups.append(new_group)
-
-        return groups
+                group.add(d)
 
-    @staticmethod
-    def find_matching_group(document: Document, groups: list["MetadataGroup"]):
-        """From a list of groups, return the first group matching the document."""
-        matching_group: Optional[MetadataGroup] = None
-        for g in groups:
-            if g.matches(document):
-                matching_group = g
-                break
-        return matching_group
+        if order_by_start_index:
+            for g in groups.values():
+                g.sort_by_start_index()
+        return list(groups.values())
@@ -1,54 +1,259 @@
 from pathlib import Path
-from typing import Optional, Any
+from typing import Optional, Any, Generator, Tuple
 
 from langchain.chains import ConversationalRetrievalChain
-from langchain.chains.conversational_retrieval.base import BaseConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import BaseConversationalRetrievalChain, _get_chat_history
+from langchain_community.vectorstores import Chroma
+from langchain_core.documents import Document
+from langchain_core.prompts import format_document
 from langchain_core.language_models import BaseLanguageModel
+from langchain_core.prompt_values import PromptValue
 
 from knowledge_net.langchain.conversions import Conversions
 from knowledge_net.langchain.document_group_transform import DocumentGroupTransform
 from knowledge_net.langchain.rag_prompts import COMBINE_DOCUMENTS_CHAT_PROMPT
+from knowledge_net.langchain.scored_retriever import ScoredRetriever
 from knowledge_net.langchain.transform_combine_chain import TransformCombineDocumentsChain
+from knowledge_net.experimental.caching.semantic_cache import SemanticCache
 from knowledge_net.experimental.database.database import Database
+from knowledge_net.experimental.database.embeddings import EmbeddingProviders
+from knowledge_net.chat.chat_event import MessageEvent, Role
 from knowledge_net.chat.chat_history import ChatHistory
 from knowledge_net.chat.chat_model import ChatModel
 
 
 class LangchainRAGChain(ChatModel):
+    """Answers questions with a conversational retrieval chain over a vector database.
+
+    With a semantic cache, the answer to a question similar enough to a previous one is taken from the cache
+    instead of being generated. The cache is emptied when the database is rebuilt, noticed by
+    :code:`Database.current_build_stamp`.
+    """
+
     LLM_DEFAULT_MODEL = "gpt-3.5-turbo"
 
     def __init__(self,
                  database_location: Path,
                  source_descriptions: dict[str, dict[str, dict[str, str]]],
                  openai_api_key: str,
-                 llm: BaseLanguageModel):
+                 llm: BaseLanguageModel,
+                 semantic_cache: Optional[SemanticCache] = None,
+                 token_budget: Optional[int] = None,
+                 embeddings: Optional[dict[str, Any]] = None):
+        self.database = Database(database_location, openai_api_key=openai_api_key, embeddings=embeddings)
+        self.semantic_cache = semantic_cache
         self.chain = LangchainRAGChain.conversational_chain(database_location, openai_api_key=openai_api_key,
-                                                            llm=llm, source_descriptions=source_descriptions)
+                                                            llm=llm, source_descriptions=source_descriptions,
+                                                            token_budget=token_budget, embeddings=embeddings)
 
     def __call__(self, chat_history: ChatHistory, originator: str) -> ChatHistory:
         langchain_question = Conversions.chat_history_to_langchain_question(chat_history)
-        langchain_response = self.chain.invoke(langchain_question)
-        return Conversions.chat_history_from_langchain_response(langchain_response, originator=originator)
+        if self.semantic_cache is None:
+            langchain_response = self.chain.invoke(langchain_question)
+            return Conversions.chat_history_from_langchain_response(langchain_response, originator=originator)
+
+        question = self.standalone_questions([langchain_question])[0]
+        embeddings, answers = self.cached_answers([question])
+        answer = answers[0]
+        if answer is None:
+            # The question is already standalone, so the chain doesn't condense it again
+            answer = self.chain.invoke({'question': question, 'chat_history': []})['answer']
+            self.remember(question, embeddings[0], answer)
+        return Conversions.chat_history_from_langchain_response({'answer': answer}, originator=originator)
+
+    async def acall(self, chat_history: ChatHistory, originator: str) -> ChatHistory:
+        """Calls the model like :code:`__call__`, with the asynchronous APIs of the question generator, the
+        embeddings, the vector store and the language model.
+
+        Steps without an asynchronous API, like the search of a Chroma database, are run in the default executor by
+        langchain.
+        """
+        langchain_question = Conversions.chat_history_to_langchain_question(chat_history)
+        if self.semantic_cache is None:
+            langchain_response = await self.chain.ainvoke(langchain_question)
+            return Conversions.chat_history_from_langchain_response(langchain_response, originator=originator)
+
+        question = await self.astandalone_question(langchain_question)
+        embedding = await self.chain.retriever.vectorstore.embeddings.aembed_query(question)
+        self.semantic_cache.validate(self.database.current_build_stamp())
+        answer = self.semantic_cache.lookup(embedding)
+        if answer is None:
+            answer = (await self.chain.ainvoke({'question': question, 'chat_history': []}))['answer']
+            self.remember(question, embedding, answer)
+        return Conversions.chat_history_from_langchain_response({'answer': answer}, originator=originator)
+
+    def stream(self, chat_history: ChatHistory, originator: str) -> Generator[MessageEvent, None, ChatHistory]:
+        """Calls the model, yields pieces of the answer as they are generated and returns the chat continuation.
+
+        Runs the steps of the conversational chain one by one, condensing the question, retrieving and transforming
+        the documents and filling in the prompt, so that the answer can be streamed from the language model.
+        Cached answers are yielded in one piece.
+        """
+        langchain_question = Conversions.chat_history_to_langchain_question(chat_history)
+        question = self.standalone_questions([langchain_question])[0]
+        embedding = None
+        if self.semantic_cache is not None:
+            embeddings, answers = self.cached_answers([question])
+            embedding, answer = embeddings[0], answers[0]
+            if answer is not None:
+                yield MessageEvent(originator=originator, role=Role.assistant, message_text=answer)
+                return Conversions.chat_history_from_langchain_response({'answer': answer}, originator=originator)
+
+        pieces = []
+        for chunk in self._llm().stream(self.prompt(question, self.chain.retriever.invoke(question))):
+            piece = LangchainRAGChain._text(chunk)
+            pieces.append(piece)
+            yield MessageEvent(originator=originator, role=Role.assistant, message_text=piece)
+        answer = ''.join(pieces)
+        self.remember(question, embedding, answer)
+        return Conversions.chat_history_from_langchain_response({'answer': answer}, originator=originator)
+
+    def batch(self, chat_histories: list[ChatHistory], originator: str) -> list[ChatHistory]:
+        """Calls the model for many chat histories and returns the continuations in order.
+
+        Runs the steps of the conversational chain for all chat histories together: the questions are condensed
+        with one batch call, embedded with one call and looked up with one vector search, see
+        :code:`retrieve_batch`, and the answers are generated with one batch call to the language model. Questions
+        with cached answers are not looked up.
+        """
+        langchain_questions = [Conversions.chat_history_to_langchain_question(h) for h in chat_histories]
+        questions = self.standalone_questions(langchain_questions)
+        embeddings: list[Optional[list[float]]] = [None] * len(questions)
+        answers: list[Optional[str]] = [None] * len(questions)
+        if self.semantic_cache is not None:
+            embeddings, answers = self.cached_answers(questions)
+
+        misses = [i for i, answer in enumerate(answers) if answer is None]
+        if misses:
+            documents = self.retrieve_batch([questions[i] for i in misses], [embeddings[i] for i in misses])
+            generated = self._llm().batch([self.prompt(questions[i], d) for i, d in zip(misses, documents)])
+            for i, output in zip(misses, generated):
+                answers[i] = LangchainRAGChain._text(output)
+                self.remember(questions[i], embeddings[i], answers[i])
+        return [Conversions.chat_history_from_langchain_response({'answer': answer}, originator=originator)
+                for answer in answers]
+
+    def cached_answers(self, questions: list[str]) -> Tuple[list[list[float]], list[Optional[str]]]:
+        """Embeds the questions and looks up the answers to similar questions in the semantic cache.
+
+        Returns the embeddings and the cached answers, None for the questions without one.
+        """
+        embeddings = self.embed_questions(questions)
+        self.semantic_cache.validate(self.database.current_build_stamp())
+        return embeddings, [self.semantic_cache.lookup(e) for e in embeddings]
+
+    def remember(self, question: str, embedding: Optional[list[float]], answer: str):
+        """Adds the generated answer to the semantic cache, if there is one."""
+        if self.semantic_cache is not None:
+            self.semantic_cache.add(embedding, question, answer)
+
+    def prompt(self, question: str, documents: list[Document]) -> PromptValue:
+        """Packs and transforms the retrieved documents and fills in the prompt of the combine documents chain."""
+        combine_chain = self.chain.combine_docs_chain
+        documents, _ = combine_chain.transform(documents)
+
+        # We assume stuff chain, like in conversational_chain
+        stuff_chain = combine_chain.combine_documents_chain
+        context = stuff_chain.document_separator.join(format_document(d, stuff_chain.document_prompt)
+                                                      for d in documents)
+        return stuff_chain.llm_chain.prompt.format_prompt(**{stuff_chain.document_variable_name: context,
+                                                             'question': question})
+
+    def embed_questions(self, questions: list[str]) -> list[list[float]]:
+        """Embeds the questions as queries with the embeddings of the database, in one call if the model can."""
+        return EmbeddingProviders.embed_queries(self.chain.retriever.vectorstore.embeddings, questions)
+
+    def retrieve_batch(self, questions: list[str], embeddings: list[Optional[list[float]]]) -> list[list[Document]]:
+        """Retrieves the documents for each question.
+
+        Similarity searches of Chroma databases are made for all the question embeddings with a single query,
+        embedding the questions not embedded yet. Other searches go through the retriever.
+        """
+        retriever = self.chain.retriever
+        if retriever.search_type != 'similarity' or not isinstance(retriever.vectorstore, Chroma):
+            return retriever.batch(questions)
+        if any(e is None for e in embeddings):
+            embeddings = self.embed_questions(questions)
+        return LangchainRAGChain._search_chroma(retriever.vectorstore, embeddings, retriever.search_kwargs)
+
+    @staticmethod
+    def _search_chroma(vectorstore: Chroma, embeddings: list[list[float]],
+                       search_kwargs: dict[str, Any]) -> list[list[Document]]:
+        """Searches the Chroma database for the documents closest to each embedding with a single query.
+
+        Chroma has no public method searching for many embeddings at once, so this adapter goes through its
+        collection, turning distances into relevance scores like :code:`ScoredRetriever` gets them.
+        """
+        results = vectorstore._collection.query(query_embeddings=embeddings, n_results=search_kwargs.get('k', 4),
+                                                where=search_kwargs.get('filter'),
+                                                include=['documents', 'metadatas', 'distances'])
+        relevance = vectorstore._select_relevance_score_fn()
+        return [ScoredRetriever.with_scores([(Document(page_content=text, metadata=metadata or {}),
+                                              relevance(distance))
+                                             for text, metadata, distance in zip(texts, metadatas, distances)])
+                for texts, metadatas, distances
+                in zip(results['documents'], results['metadatas'], results['distances'])]
+
+    async def astandalone_question(self, langchain_question: dict[str, Any]) -> str:
+        """Rephrases a follow-up question as a standalone question with the asynchronous API."""
+        if not langchain_question['chat_history']:
+            return langchain_question['question']
+        get_chat_history = self.chain.get_chat_history or _get_chat_history
+        output = await self.chain.question_generator.ainvoke({
+            'question': langchain_question['question'],
+            'chat_history': get_chat_history(langchain_question['chat_history'])})
+        return output[self.chain.question_generator.output_key]
+
+    def standalone_questions(self, langchain_questions: list[dict[str, Any]]) -> list[str]:
+        """Rephrases follow-up questions as standalone questions with one batch call to the question generator."""
+        questions = [q['question'] for q in langchain_questions]
+        follow_ups = [i for i, q in enumerate(langchain_questions) if q['chat_history']]
+        if follow_ups:
+            get_chat_history = self.chain.get_chat_history or _get_chat_history
+            outputs = self.chain.question_generator.batch([
+                {'question': questions[i], 'chat_history': get_chat_history(langchain_questions[i]['chat_history'])}
+                for i in follow_ups])
+            for i, output in zip(follow_ups, outputs):
+                questions[i] = output[self.chain.question_generator.output_key]
+        return questions
+
+    def _llm(self) -> BaseLanguageModel:
+        # We assume stuff chain, like in conversational_chain
+        return self.chain.combine_docs_chain.combine_documents_chain.llm_chain.llm
+
+    @staticmethod
+    def _text(output: Any) -> str:
+        """Returns the text of the output of a chat model or language model."""
+        return output.content if hasattr(output, 'content') else output
 
     @staticmethod
     def conversational_chain(database_location: Path,
                              openai_api_key: str,
                              llm: BaseLanguageModel,
-                             source_descriptions: Optional[dict[str, Any]] = None) -> BaseConversationalRetrievalChain:
-        """Instantiates a conversational retrieval chain."""
+                             source_descriptions: Optional[dict[str, Any]] = None,
+                             token_budget: Optional[int] = None,
+                             embeddings: Optional[dict[str, Any]] = None) -> BaseConversationalRetrievalChain:
+        """Instantiates a conversational retrieval chain.
+
+        The retrieved documents are packed into :code:`token_budget` tokens, if given, see
+        :code:`TransformCombineDocumentsChain`. Questions are embedded with the provider configured in
+        :code:`embeddings`, which must be the one the database was built with.
+        """
 
-        database = Database(database_location, openai_api_key=openai_api_key).load()
-        retriever = database.as_retriever()
+        database = Database(database_location, openai_api_key=openai_api_key, embeddings=embeddings).load()
+        retriever = ScoredRetriever(vectorstore=database)
         chain = ConversationalRetrievalChain.from_llm(
             llm,
             retriever=retriever,
             memory=None,
             verbose=True
         )
-        document_transform = DocumentGroupTransform(key='source', descriptions=source_descriptions)
+        document_transform = DocumentGroupTransform(key='source', descriptions=source_descriptions,
+                                                    merge_overlapping=True)
         chain.combine_docs_chain \
             = TransformCombineDocumentsChain(document_transform=document_transform,
-                                             combine_documents_chain=chain.combine_docs_chain)
+                                             combine_documents_chain=chain.combine_docs_chain,
+                                             token_budget=token_budget)
 
         # We assume stuff chain and chat language model
         chain.combine_docs_chain.combine_documents_chain.llm_chain.prompt = COMBINE_DOCUMENTS_CHAT_PROMPT
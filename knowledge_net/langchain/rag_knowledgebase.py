@@ -1,16 +1,24 @@
 import json
 from pathlib import Path
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Generator, Any
 
 from langchain_core.language_models import BaseLanguageModel
 
+from knowledge_net.chat.chat_event import MessageEvent
 from knowledge_net.chat.chat_history import ChatHistory
+from knowledge_net.experimental.caching.semantic_cache import SemanticCache
 from knowledge_net.knowledgebase.knowledgebase import Knowledgebase
 from knowledge_net.langchain.rag_chain import LangchainRAGChain
 
 
 class LangchainRAGKnowledgebase(Knowledgebase):
-    """Knowledgebase based on retrieval from a vector database."""
+    """Knowledgebase based on retrieval from a vector database.
+
+    Set :code:`semantic_cache_threshold` to answer questions similar to previous ones from a semantic cache, see
+    :code:`SemanticCache`. Set :code:`context_token_budget` to limit the number of tokens of the retrieved text in
+    the prompt, see :code:`TransformCombineDocumentsChain`. Set :code:`embeddings` to embed questions with the
+    provider the database was built with, if not OpenAI, see :code:`EmbeddingProviders`.
+    """
 
     def __init__(self,
                  database_location: Path,
@@ -19,15 +27,33 @@ class LangchainRAGKnowledgebase(Knowledgebase):
                  openai_api_key: str,
                  llm: BaseLanguageModel,
                  display_name: Optional[str] = None,
-                 description: str = None):
+                 description: str = None,
+                 semantic_cache_threshold: Optional[float] = None,
+                 context_token_budget: Optional[int] = None,
+                 embeddings: Optional[dict[str, Any]] = None):
         super().__init__(identifier=identifier, display_name=display_name, description=description)
         source_descriptions = self.get_source_descriptions(source_descriptions_file)
+        semantic_cache = SemanticCache(threshold=semantic_cache_threshold) \
+            if semantic_cache_threshold is not None else None
         self.chain = LangchainRAGChain(database_location, openai_api_key=openai_api_key,
-                                       source_descriptions=source_descriptions, llm=llm)
+                                       source_descriptions=source_descriptions, llm=llm,
+                                       semantic_cache=semantic_cache, token_budget=context_token_budget,
+                                       embeddings=embeddings)
 
     def _reply(self, chat_history: ChatHistory) -> Tuple[ChatHistory, Optional[str]]:
         return self.chain(chat_history, originator=self.identifier), None
 
+    def _reply_batch(self, chat_histories: list[ChatHistory]) -> list[Tuple[ChatHistory, Optional[str]]]:
+        return [(continuation, None) for continuation in self.chain.batch(chat_histories, originator=self.identifier)]
+
+    async def _areply(self, chat_history: ChatHistory) -> Tuple[ChatHistory, Optional[str]]:
+        return await self.chain.acall(chat_history, originator=self.identifier), None
+
+    def _reply_stream(self, chat_history: ChatHistory) \
+            -> Generator[MessageEvent, None, Tuple[ChatHistory, Optional[str]]]:
+        continuation = yield from self.chain.stream(chat_history, originator=self.identifier)
+        return continuation, None
+
     @staticmethod
     def get_source_descriptions(source_descriptions_file: Path) -> dict[str, dict[str, dict[str, str]]]:
         with open(source_descriptions_file, 'r') as f:
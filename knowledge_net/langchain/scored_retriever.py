@@ -0,0 +1,32 @@
+from typing import List, Tuple
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStoreRetriever
+
+
+class ScoredRetriever(VectorStoreRetriever):
+    """Vector store retriever putting the relevance score of each document in its :code:`score` metadata.
+
+    Similarity searches are made with relevance scores, so that a token budget can rank the documents, see
+    :code:`TransformCombineDocumentsChain`. Other search types are left to the base class.
+    """
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        if self.search_type != 'similarity':
+            return super()._get_relevant_documents(query, run_manager=run_manager)
+        return ScoredRetriever.with_scores(
+            self.vectorstore.similarity_search_with_relevance_scores(query, **self.search_kwargs))
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        if self.search_type != 'similarity':
+            return await super()._aget_relevant_documents(query, run_manager=run_manager)
+        return ScoredRetriever.with_scores(
+            await self.vectorstore.asimilarity_search_with_relevance_scores(query, **self.search_kwargs))
+
+    @staticmethod
+    def with_scores(results: List[Tuple[Document, float]]) -> List[Document]:
+        """Returns the documents with their scores added to copies of their metadata."""
+        return [Document(page_content=d.page_content, metadata={**d.metadata, 'score': score})
+                for d, score in results]
@@ -0,0 +1,53 @@
+import threading
+import warnings
+from functools import lru_cache
+from typing import Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+class TokenCounter:
+    """Counts the tokens of texts, remembering the counts of recently counted texts.
+
+    Tokens are counted with the tiktoken encoding :code:`encoding_name`. If tiktoken is not installed or the
+    encoding cannot be loaded, e.g. on a machine without network access, the count is estimated as one token per
+    four characters.
+    """
+
+    DEFAULT_ENCODING = "cl100k_base"
+    DEFAULT_MAX_ENTRIES = 10000
+    CHARACTERS_PER_TOKEN = 4
+    """Characters per token of the estimate used without tiktoken"""
+
+    def __init__(self, encoding_name: str = DEFAULT_ENCODING, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.count = lru_cache(maxsize=max_entries)(self._count)
+
+    def __call__(self, text: str) -> int:
+        """Returns the number of tokens of the text."""
+        return self.count(text)
+
+    def _count(self, text: str) -> int:
+        encoding = self.encoding()
+        if encoding is None:
+            return (len(text) + TokenCounter.CHARACTERS_PER_TOKEN - 1) // TokenCounter.CHARACTERS_PER_TOKEN
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def encoding(self) -> Optional["tiktoken.Encoding"]:
+        """Returns the tiktoken encoding, loading it on first use, or None if it is not available."""
+        with self._lock:
+            if not self._loaded:
+                self._loaded = True
+                if tiktoken is not None:
+                    try:
+                        self._encoding = tiktoken.get_encoding(self.encoding_name)
+                    except Exception as e:
+                        warnings.warn(f"Could not load the tiktoken encoding {self.encoding_name}, "
+                                      f"estimating token counts instead: {e}")
+            return self._encoding
@@ -1,16 +1,32 @@
+import logging
 from typing import Callable, List, Any, Tuple, Optional
 from langchain.chains.combine_documents.base import BaseCombineDocumentsChain
-from langchain.schema import Document
+from langchain.schema import Document, format_document
+from langchain_core.pydantic_v1 import Field
+
+from knowledge_net.langchain.token_counter import TokenCounter
+
+logger = logging.getLogger(__name__)
 
 
 class TransformCombineDocumentsChain(BaseCombineDocumentsChain):
     """Extends the combine documents chain with a step that transforms the list of input documents.
 
     For example, it can be used to group and annotate documents according to source or other metadata.
+
+    With a :code:`token_budget`, the documents are packed into the budget: they are ranked by their :code:`score`
+    metadata, or by their order from the retriever if they have none, and added greedily while the transformed
+    documents fit, counted as they go into the prompt, with introductions, quotes and separators and with merged
+    overlaps counted once, see :code:`pack`. Transformed groups come in the order of their best document. The number of tokens and
+    documents left out is returned as :code:`dropped_tokens` and :code:`dropped_documents` in the extra dictionary
+    of :code:`combine_docs`, and logged.
     """
 
     document_transform: Callable[[list[Document]], list[Document]]
     combine_documents_chain: BaseCombineDocumentsChain
+    token_budget: Optional[int] = None
+    """Maximum number of tokens of the input documents, None for no limit"""
+    token_counter: TokenCounter = Field(default_factory=TokenCounter)
 
     @property
     def input_keys(self) -> List[str]:
@@ -24,14 +40,71 @@ class TransformCombineDocumentsChain(BaseCombineDocumentsChain):
         return self.combine_documents_chain.prompt_length(docs, **kwargs)
 
     def combine_docs(self, docs: List[Document], **kwargs: Any) -> Tuple[str, dict]:
-        docs = self.document_transform(docs)
-        return self.combine_documents_chain.combine_docs(docs, **kwargs)
+        docs, extra = self.transform(docs)
+        output, combine_extra = self.combine_documents_chain.combine_docs(docs, **kwargs)
+        return output, {**combine_extra, **extra}
 
     async def acombine_docs(self, docs: List[Document], **kwargs: Any) -> Tuple[str, dict]:
-        docs = self.document_transform(docs)
-        return await self.combine_documents_chain.acombine_docs(docs, **kwargs)
+        docs, extra = self.transform(docs)
+        output, combine_extra = await self.combine_documents_chain.acombine_docs(docs, **kwargs)
+        return output, {**combine_extra, **extra}
+
+    def transform(self, docs: List[Document]) -> Tuple[List[Document], dict]:
+        """Packs the documents into the token budget and transforms them.
+
+        Returns the transformed documents and a dictionary with the number of dropped tokens and documents.
+        """
+        if self.token_budget is None:
+            return self.document_transform(docs), {}
+        transformed, packed = self.pack(docs)
+        packed_ids = {id(d) for d in packed}
+        dropped = [d for d in docs if id(d) not in packed_ids]
+        dropped_tokens = sum(self.token_counter(d.page_content) for d in dropped)
+        if dropped:
+            logger.info(f"Dropped {len(dropped)} documents with {dropped_tokens} tokens "
+                        f"to fit the budget of {self.token_budget} tokens")
+        return transformed, {'dropped_tokens': dropped_tokens, 'dropped_documents': len(dropped)}
+
+    def pack(self, docs: List[Document]) -> Tuple[List[Document], List[Document]]:
+        """Adds the best ranked documents while the transformed documents fit in the token budget.
+
+        The token count is kept up to date incrementally: adding a document only transforms and counts the group
+        it joins, if the transform has a :code:`group_value` method telling the group of a document, like
+        :code:`DocumentGroupTransform`. Otherwise all documents are one group. Returns the transformed documents
+        and the input documents they were made from, best first.
+        """
+        ranked = [d for _, d in sorted(enumerate(docs), key=lambda item: (-item[1].metadata.get('score', 0),
+                                                                          item[0]))]
+        group_value = getattr(self.document_transform, 'group_value', lambda d: None)
+        separator_tokens = self.token_counter(getattr(self.combine_documents_chain, 'document_separator', "\n\n"))
+        groups: dict[Any, List[Document]] = {}
+        group_tokens: dict[Any, int] = {}
+        used = 0
+        packed = []
+        for d in ranked:
+            value = group_value(d)
+            candidate = groups.get(value, []) + [d]
+            tokens = self.count_tokens(self.document_transform(candidate))
+            separator = separator_tokens if groups and value not in groups else 0
+            total = used - group_tokens.get(value, 0) + tokens + separator
+            if total <= self.token_budget:
+                groups[value], group_tokens[value], used = candidate, tokens, total
+                packed.append(d)
+        return self.document_transform(packed), packed
+
+    def count_tokens(self, docs: List[Document]) -> int:
+        """Returns the number of tokens the documents take up in the prompt, with their separators.
+
+        Each formatted document is counted on its own, so that the counts of unchanged documents come from the
+        cache of the token counter.
+        """
+        chain = self.combine_documents_chain
+        document_prompt = getattr(chain, 'document_prompt', None)
+        tokens = sum(self.token_counter(format_document(d, document_prompt) if document_prompt is not None
+                                        else d.page_content) for d in docs)
+        separator_tokens = self.token_counter(getattr(chain, 'document_separator', "\n\n"))
+        return tokens + separator_tokens * max(len(docs) - 1, 0)
 
     @property
     def _chain_type(self) -> str:
         return self.combine_documents_chain._chain_type
-
@@ -67,10 +67,10 @@ if prompt := st.chat_input("What do you want to learn about?"):
     with st.chat_message("user"):
         st.markdown(prompt)
     st.session_state.chat_history.append(MessageEvent(message_text=prompt))
-    response = st.session_state.kb.reply(st.session_state.chat_history)
-    for message in response.get_messages():
-        with st.chat_message(message.role):
-            st.markdown(message.message_text)
+    stream = st.session_state.kb.reply_stream(st.session_state.chat_history)
+    with st.chat_message("assistant"):
+        st.write_stream(stream.text())
+    response = stream.continuation
     if response.returned_error():
         called, error = response.get_error()
         with st.chat_message("assistant"):